@@ -1,6 +1,6 @@
-import sys
-
-from spPipeline.cli import main
-
-if __name__ == "__main__":
-    main()
+import sys
+
+from spPipeline.cli import main
+
+if __name__ == "__main__":
+    main()
@@ -1,124 +1,411 @@
-import re, shutil, warnings, sys
-from time import time
-from datetime import datetime
-from os import chdir, listdir, getcwd, path, makedirs, remove, walk
-import numpy as np
-import matplotlib.pyplot as plt
-import scipy.ndimage as ndimage
-from spPipeline.code_lib import tifffile as tiff # Qiwen: packed as python package, same below
-from spPipeline.code_lib import TwoDimensionalAligner_2 as myAligner # Kian: added 201011
-
-
-def listdirectories(directory='.', pattern='*'):
-    """ returns a list of all directories in path"""
-
-    # Qiwen's comment: code is simplified here
-    directories = [i for i in next(walk(directory))[1]]
-    directories.sort()
-    return directories
-
-
-def mip_gauss_tiled(rnd, fov, dir_root, dir_output='./MIP_gauss',
-                        sigma=0.7, channel_int='ch00'):
-    """Modified from Matt Cai's MIP.py Maximum intensity projection along z-axis """
-    # get current directory and change to working directory - Qiwen's comment don't need this
-    # Qiwen: I modified all the dirs so that we can generalize it
-    anchor_dir = dir_root + "/" + rnd
-
-    # get all files for position for channel
-    image_names = [f for f in listdir(anchor_dir) if
-                    re.match(r'.*_s' + '{:02d}'.format(fov) + r'.*_' + channel_int + r'\.tif', f)]
-
-    # put images of correct z_range in list of array
-    nImages = len(image_names)
-    image_list = [None] * nImages
-    for i in range(len(image_names)):
-        # Qiwen: modify path here to find target image
-        image_list[i] = (ndimage.gaussian_filter(plt.imread(path.join(anchor_dir, image_names[i])),
-                                                 sigma=sigma))
-    image_stack = np.dstack(image_list)
-    max_array = np.amax(image_stack, axis=2)
-
-    # PIL unable to save uint16 tif file
-    # Need to use alternative (like libtiff)
-    # Make directories if necessary
-    if not dir_output.endswith('/'):
-        dir_output = "{0}/".format(dir_output)
-
-    if not path.isdir(dir_output + 'FOV{:03d}'.format(fov)):
-        makedirs(dir_output + 'FOV{:03d}'.format(fov))
-
-    tiff.imsave(path.join(dir_output, 'FOV{:03d}'.format(fov) + '/MIP_' + rnd + '_FOV{:03d}'.format(fov) +
-                    '_' + channel_int + '.tif'), max_array)
-
-
-class ImageAlign:
-    """Class for image alignment and registration """
-
-    def __init__(self, raw_dir, output_dir, rnd_list, n_fovs, sigma,
-                 channel_DIC_reference, channel_DIC, cycle_other, channel_DIC_other, **kwargs):
-        # path to raw files (e.g. ./0_Raw)
-        self.raw_dir = raw_dir
-        # path of output files
-        self.output_dir = output_dir
-        # rounds
-        self.rnd_list = rnd_list
-        # Number of FOVs (field of views)
-        self.n_fovs = n_fovs
-        # signma parameter for gaussian filter
-        self.sigma = sigma
-        self.channel_DIC_reference = channel_DIC_reference
-        self.channel_DIC = channel_DIC
-        self.cycle_other = cycle_other
-        self.channel_DIC_reference = channel_DIC_reference
-        self.channel_DIC_other = channel_DIC_other
-        self.dir_output_Projected = path.join(output_dir, "1_Projected")
-        self.dir_output_aligned = path.join(output_dir, "2_Registered")
-        self.cycle_reference = rnd_list[round(len(self.rnd_list) / 2)]
-
-    def get_maximum_intensity(self):
-        # MIP
-        for rnd in self.rnd_list:
-            if "DRAQ5" in rnd or "anchor" in rnd:
-                channel_list = [0, 1]
-            else:
-                channel_list = [0, 1, 2, 3]
-
-            for channel in channel_list:
-                print('Generating MIPs for ' + rnd + ' channel {0} ...'.format(channel))
-                for fov in range(self.n_fovs):
-                    mip_gauss_tiled(rnd, fov, self.raw_dir, self.dir_output_Projected,
-                                    sigma=self.sigma, channel_int="ch0{0}".format(channel))
-                print('Done\n')
-
-    def dimension_align_2d(self):
-        position_list = listdirectories(path.join(self.dir_output_Projected))
-
-        if not path.isdir(self.dir_output_aligned):
-            makedirs(self.dir_output_aligned)
-
-        currentTime = datetime.now()
-        reportFile = path.join(self.dir_output_aligned,
-                               currentTime.strftime("%Y-%d-%m_%H:%M_SITKAlignment.log"))
-        # redirecting the stdout to the log file
-        sys.stdout = open(reportFile, 'w')
-
-        for position in position_list:
-            for rnd in self.rnd_list:
-                print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: " + str(position) +
-                                              ', cycle ' + rnd + ' started to align'))
-                aligner = myAligner.TwoDimensionalAligner(
-                    destinationImagesFolder=path.join(self.dir_output_Projected, position),
-                    originImagesFolder=path.join(self.dir_output_Projected, position),
-                    originMatchingChannel=self.channel_DIC if rnd not in self.cycle_other else self.channel_DIC_other[rnd],
-                    destinationMatchingChannel=self.channel_DIC_reference,
-                    imagesPosition=position,
-                    destinationCycle=self.cycle_reference,
-                    originCycle=rnd,
-                    resultDirectory=path.join(self.dir_output_aligned, position),
-                    MaximumNumberOfIterations=400)
-
-                for file in [file for file in listdir() if file.startswith('IterationInfo.0')]:
-                    if path.isfile(path.join(self.dir_output_aligned, position, "MetaData", file)):
-                        remove(path.join(self.dir_output_aligned, position, "MetaData", file))
-                        shutil.move(src=file, dst=path.join(self.dir_output_aligned, position, "MetaData"))
+import re, warnings, logging
+from time import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import chdir, getcwd, path, makedirs, walk, cpu_count
+import numpy as np
+import scipy.ndimage as ndimage
+from spPipeline.code_lib import tifffile as tiff # Qiwen: packed as python package, same below
+from spPipeline.code_lib import TwoDimensionalAligner_2 as myAligner # Kian: added 201011
+from spPipeline.rawIndex import get_raw_index
+from spPipeline.imageIO import read_plane
+from spPipeline.metrics import measure
+from spPipeline.stageLogging import stage_log
+
+logger = logging.getLogger(__name__)
+
+
+def listdirectories(directory='.', pattern='*'):
+    """ returns a list of all directories in path"""
+
+    # Qiwen's comment: code is simplified here
+    directories = [i for i in next(walk(directory))[1]]
+    directories.sort()
+    return directories
+
+
+def gauss_max_streaming(planes, sigma=0.7, reader=None):
+    """ Filters each z-plane as it is read and folds it into a running maximum,
+        so memory stays at a couple of planes however deep the z-stack is.
+        Exactly the per-plane ndimage.gaussian_filter + np.amax projection.
+    """
+    read = reader if reader is not None else np.asarray
+    max_array = None
+    filtered = None
+    for plane in planes:
+        image = read(plane)
+        if max_array is None:
+            max_array = ndimage.gaussian_filter(image, sigma=sigma)
+            filtered = np.empty_like(max_array)
+        else:
+            ndimage.gaussian_filter(image, sigma=sigma, output=filtered)
+            np.maximum(max_array, filtered, out=max_array)
+    if max_array is None:
+        raise ValueError("Empty z-stack")
+    return max_array
+
+
+def gauss_max_projection(planes, sigma=0.7, z_block=8, reader=None):
+    """ Filter-then-project engine for a whole z-stack.
+        `planes` is a (z, y, x) array or a sequence of 2D planes; with `reader`, it is a sequence of
+        paths and reader(path) returns the plane. Planes are filtered `z_block` at a time with one
+        vectorized 2D Gaussian call (sigma 0 along z) in float32, into preallocated buffers, and folded
+        into a running maximum, so memory is bounded by `z_block` planes.
+        The projection is returned in the dtype of the planes. It matches the per-plane
+        ndimage.gaussian_filter path within 2 grey levels for integer images: that path truncates
+        to the integer dtype after each 1D pass, this one only once at the end.
+    """
+    nplanes = len(planes)
+    if nplanes == 0:
+        raise ValueError("Empty z-stack")
+    read = reader if reader is not None else np.asarray
+
+    first = read(planes[0])
+    z_block = max(1, min(z_block, nplanes))
+    block = np.empty((z_block,) + first.shape, dtype=np.float32)
+    filtered = np.empty_like(block)
+    block_max = np.empty(first.shape, dtype=np.float32)
+    max_array = np.full(first.shape, -np.inf, dtype=np.float32)
+
+    for start in range(0, nplanes, z_block):
+        n = min(z_block, nplanes - start)
+        for i in range(n):
+            block[i] = first if start + i == 0 else read(planes[start + i])
+        ndimage.gaussian_filter(block[:n], sigma=(0, sigma, sigma), output=filtered[:n])
+        np.amax(filtered[:n], axis=0, out=block_max)
+        np.maximum(max_array, block_max, out=max_array)
+
+    if np.issubdtype(first.dtype, np.integer):
+        info = np.iinfo(first.dtype)
+        np.clip(max_array, info.min, info.max, out=max_array)
+    return max_array.astype(first.dtype)
+
+
+def mip_name(rnd, fov, channel_int):
+    """ file name of a maximum projection, the same in 1_Projected and 2_Registered """
+    return 'MIP_' + rnd + '_FOV{:03d}'.format(fov) + '_' + channel_int + '.tif'
+
+
+def project_z_stack(image_paths, sigma=0.7, z_block=None):
+    """ Gaussian-filtered maximum projection of the z-planes in `image_paths`:
+        streamed plane by plane, or in vectorized blocks of `z_block` planes
+    """
+    if z_block is None:
+        return gauss_max_streaming(image_paths, sigma=sigma, reader=read_plane)
+    return gauss_max_projection(image_paths, sigma=sigma, z_block=z_block, reader=read_plane)
+
+
+def mip_gauss_tiled(rnd, fov, dir_root, dir_output='./MIP_gauss',
+                        sigma=0.7, channel_int='ch00', image_names=None, z_block=None):
+    """Modified from Matt Cai's MIP.py Maximum intensity projection along z-axis
+       image_names: z-plane file names of this fov and channel; looked up in the raw file index if not given.
+       z_block: if given, planes are filtered in vectorized blocks of this many planes by `gauss_max_projection`.
+    """
+    # get current directory and change to working directory - Qiwen's comment don't need this
+    # Qiwen: I modified all the dirs so that we can generalize it
+    anchor_dir = dir_root + "/" + rnd
+
+    # get all files for position for channel
+    if image_names is None:
+        image_names = get_raw_index(anchor_dir).lookup(fov, channel_int)
+
+    # Qiwen: modify path here to find target image
+    image_paths = [path.join(anchor_dir, image_name) for image_name in image_names]
+    if not image_paths:
+        raise FileNotFoundError("No z-planes found for {0} FOV{1:03d} {2} in {3}".format(rnd, fov, channel_int,
+                                                                                         anchor_dir))
+    with measure('MIP', fov=fov, rnd=rnd, channel=channel_int):
+        max_array = project_z_stack(image_paths, sigma=sigma, z_block=z_block)
+
+        # PIL unable to save uint16 tif file
+        # Need to use alternative (like libtiff)
+        # Make directories if necessary
+        if not dir_output.endswith('/'):
+            dir_output = "{0}/".format(dir_output)
+
+        # exist_ok: several pool workers may create the same FOV directory
+        makedirs(dir_output + 'FOV{:03d}'.format(fov), exist_ok=True)
+
+        tiff.imsave(path.join(dir_output, 'FOV{:03d}'.format(fov), mip_name(rnd, fov, channel_int)), max_array)
+
+
+def _mip_job(rnd, fov, dir_root, dir_output, sigma, channel_int, image_names=None, z_block=None):
+    """ runs a single MIP job on a process pool; its time and I/O are recorded by `measure('MIP', ...)` """
+    mip_gauss_tiled(rnd, fov, dir_root, dir_output, sigma=sigma, channel_int=channel_int,
+                    image_names=image_names, z_block=z_block)
+    return rnd, fov, channel_int
+
+
+def align_position(position, rnd_list, dir_projected, dir_aligned, cycle_reference,
+                   channel_DIC_reference, channel_DIC, cycle_other, channel_DIC_other, numberOfThreads=None,
+                   **alignerOptions):
+    """ registers every round of one position (FOV directory) to the reference cycle;
+        the reference image is read once and shared by all rounds through a RegistrationSession.
+        alignerOptions are passed on to TwoDimensionalAligner (e.g. preRegistration, translationOnlyPeak)
+    """
+    session = myAligner.RegistrationSession(
+        destinationImagesFolder=path.join(dir_projected, position),
+        destinationMatchingChannel=channel_DIC_reference,
+        imagesPosition=position,
+        destinationCycle=cycle_reference)
+    fov = int(re.sub(r'\D', '', position))
+    for rnd in rnd_list:
+        logger.info(str(position) + ', cycle ' + rnd + ' started to align')
+        with measure('register', fov=fov, rnd=rnd):
+            session.align(
+                originImagesFolder=path.join(dir_projected, position),
+                originMatchingChannel=channel_DIC if rnd not in cycle_other else channel_DIC_other[rnd],
+                originCycle=rnd,
+                resultDirectory=path.join(dir_aligned, position),
+                MaximumNumberOfIterations=400,
+                numberOfThreads=numberOfThreads,
+                **alignerOptions)
+
+
+def _align_job(position, log_dir, args, alignerOptions):
+    """ aligns one position in a pool worker, logging to log_dir/<position>_SITKAlignment.log """
+    start = time()
+    with stage_log('SITKAlignment', log_dir, worker=position):
+        align_position(position, *args, **alignerOptions)
+    return position, time() - start
+
+
+class ImageAlign:
+    """Class for image alignment and registration """
+
+    def __init__(self, raw_dir, output_dir, rnd_list, n_fovs, sigma,
+                 channel_DIC_reference, channel_DIC, cycle_other, channel_DIC_other, **kwargs):
+        # path to raw files (e.g. ./0_Raw)
+        self.raw_dir = raw_dir
+        # path of output files
+        self.output_dir = output_dir
+        # rounds
+        self.rnd_list = rnd_list
+        # Number of FOVs (field of views)
+        self.n_fovs = n_fovs
+        # signma parameter for gaussian filter
+        self.sigma = sigma
+        self.channel_DIC_reference = channel_DIC_reference
+        self.channel_DIC = channel_DIC
+        self.cycle_other = cycle_other
+        self.channel_DIC_reference = channel_DIC_reference
+        self.channel_DIC_other = channel_DIC_other
+        self.dir_output_Projected = path.join(output_dir, "1_Projected")
+        self.dir_output_aligned = path.join(output_dir, "2_Registered")
+        self.cycle_reference = rnd_list[round(len(self.rnd_list) / 2)]
+        # number of worker processes; 1 keeps everything in the current process
+        self.workers = kwargs.get('workers', 1)
+        # z-planes per vectorized Gaussian block in the MIP; None filters plane by plane
+        self.z_block = kwargs.get('z_block', None)
+        # fused mode: whether the in-memory projections are also written to disk
+        self.write_projected = kwargs.get('write_projected', False)
+        # elastix threads per registration; by default the cores are shared out among the workers
+        self.elastix_threads = kwargs.get('elastix_threads', None)
+        if self.elastix_threads is None and self.workers > 1:
+            self.elastix_threads = max(1, cpu_count() // self.workers)
+        # FFT phase-correlation translation estimate seeding elastix, the correlation peak above which
+        # that translation is used as is, without running elastix, reuse of cached transforms, and the
+        # pixel type and compression of the registered images
+        self.aligner_options = {'preRegistration': kwargs.get('pre_registration', False),
+                                'translationOnlyPeak': kwargs.get('translation_only_peak', None),
+                                'useTransformCache': kwargs.get('transform_cache', True),
+                                'outputPixelType': kwargs.get('registered_dtype', 'uint8'),
+                                'outputCompression': kwargs.get('registered_compression', 0)}
+
+    def channel_list(self, rnd):
+        if "DRAQ5" in rnd or "anchor" in rnd:
+            return [0, 1]
+        return [0, 1, 2, 3]
+
+    def raw_index(self, rnd):
+        """ index of the raw z-planes of a round; each round directory is scanned once per run """
+        return get_raw_index(path.join(self.raw_dir, rnd))
+
+    def mip_jobs(self):
+        """ all (round, fov, channel) MIP jobs, in the order the serial loop runs them """
+        return [(rnd, fov, "ch0{0}".format(channel))
+                for rnd in self.rnd_list
+                for channel in self.channel_list(rnd)
+                for fov in range(self.n_fovs)]
+
+    def get_maximum_intensity(self):
+        # MIP
+        if self.workers > 1:
+            self.get_maximum_intensity_parallel()
+            return
+
+        for rnd in self.rnd_list:
+            for channel in self.channel_list(rnd):
+                logger.info('Generating MIPs for ' + rnd + ' channel {0} ...'.format(channel))
+                channel_int = "ch0{0}".format(channel)
+                for fov in range(self.n_fovs):
+                    mip_gauss_tiled(rnd, fov, self.raw_dir, self.dir_output_Projected,
+                                    sigma=self.sigma, channel_int=channel_int,
+                                    image_names=self.raw_index(rnd).lookup(fov, channel_int),
+                                    z_block=self.z_block)
+                logger.info('Done')
+
+    def get_maximum_intensity_parallel(self):
+        """ Same as `get_maximum_intensity`, but every (round, fov, channel) is
+            an independent job on a pool of `self.workers` processes
+        """
+        jobs = self.mip_jobs()
+        logger.info('Generating {0} MIPs on {1} workers ...'.format(len(jobs), self.workers))
+        start = time()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            # file lists come from the index in this process, so workers never scan the raw directories
+            futures = [executor.submit(_mip_job, rnd, fov, self.raw_dir, self.dir_output_Projected,
+                                       self.sigma, channel_int, self.raw_index(rnd).lookup(fov, channel_int),
+                                       self.z_block)
+                       for rnd, fov, channel_int in jobs]
+            for future in as_completed(futures):
+                rnd, fov, channel_int = future.result()
+                logger.debug('MIP {0} FOV{1:03d} {2} done'.format(rnd, fov, channel_int))
+        logger.info('Done in {0:.1f}s'.format(time() - start))
+
+    def dimension_align_2d(self):
+        position_list = listdirectories(path.join(self.dir_output_Projected))
+
+        if not path.isdir(self.dir_output_aligned):
+            makedirs(self.dir_output_aligned)
+
+        # the alignment is logged to 2_Registered/SITKAlignment.log
+        with stage_log('SITKAlignment', self.dir_output_aligned):
+            if self.workers > 1:
+                self.dimension_align_2d_parallel(position_list)
+                return
+
+            for position in position_list:
+                align_position(position, *self.align_args(), **self.aligner_options)
+
+    def align_args(self):
+        """ arguments of `align_position` after the position """
+        return (self.rnd_list, self.dir_output_Projected, self.dir_output_aligned, self.cycle_reference,
+                self.channel_DIC_reference, self.channel_DIC, self.cycle_other, self.channel_DIC_other,
+                self.elastix_threads)
+
+    def dimension_align_2d_parallel(self, position_list):
+        """ Registers the positions on a pool of `self.workers` processes.
+            Each worker logs to the position's own log in MetaData, and elastix
+            writes its IterationInfo files there too, so workers never share files.
+        """
+        logger.info("aligning {0} positions on {1} workers, {2} elastix threads each".format(
+            len(position_list), self.workers, self.elastix_threads))
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = []
+            for position in position_list:
+                log_dir = path.join(self.dir_output_aligned, position, "MetaData")
+                makedirs(log_dir, exist_ok=True)
+                futures.append(executor.submit(_align_job, position, log_dir,
+                                               self.align_args(), self.aligner_options))
+            for future in as_completed(futures):
+                position, elapsed = future.result()
+                logger.info(str(position) + ' aligned in {0:.1f}s'.format(elapsed))
+
+    def raw_paths(self, fov):
+        """ raw z-plane files of every round and channel of `fov` """
+        return [path.join(self.raw_dir, rnd, image_name)
+                for rnd in self.rnd_list for channel in self.channel_list(rnd)
+                for image_name in self.raw_index(rnd).lookup(fov, "ch0{0}".format(channel))]
+
+    def mip_paths(self, directory, fov):
+        """ MIP files of every round and channel of `fov` in `directory` (1_Projected or 2_Registered) """
+        return [path.join(directory, 'FOV{:03d}'.format(fov), mip_name(rnd, fov, "ch0{0}".format(channel)))
+                for rnd in self.rnd_list for channel in self.channel_list(rnd)]
+
+    def get_maximum_intensity_fov(self, fov):
+        """ MIPs of every round and channel of one FOV, written to 1_Projected (one scheduler task) """
+        for rnd in self.rnd_list:
+            for channel in self.channel_list(rnd):
+                channel_int = "ch0{0}".format(channel)
+                mip_gauss_tiled(rnd, fov, self.raw_dir, self.dir_output_Projected,
+                                sigma=self.sigma, channel_int=channel_int,
+                                image_names=self.raw_index(rnd).lookup(fov, channel_int),
+                                z_block=self.z_block)
+
+    def align_fov(self, fov):
+        """ registers the MIPs of one FOV (one scheduler task), logging to the position's MetaData """
+        position = 'FOV{:03d}'.format(fov)
+        return _align_job(position, path.join(self.dir_output_aligned, position, "MetaData"),
+                          self.align_args(), self.aligner_options)
+
+    def project_fov(self, fov):
+        """ in-memory MIPs of every round and channel of `fov`: {(rnd, channel_int): array} """
+        projections = {}
+        for rnd in self.rnd_list:
+            for channel in self.channel_list(rnd):
+                channel_int = "ch0{0}".format(channel)
+                image_paths = [path.join(self.raw_dir, rnd, image_name)
+                               for image_name in self.raw_index(rnd).lookup(fov, channel_int)]
+                if not image_paths:
+                    raise FileNotFoundError("No z-planes found for {0} FOV{1:03d} {2}".format(rnd, fov, channel_int))
+                projections[(rnd, channel_int)] = project_z_stack(image_paths, sigma=self.sigma, z_block=self.z_block)
+        return projections
+
+    def project_and_align_fov(self, fov):
+        """ Fused MIP and registration of one FOV: the projections are registered from memory and each
+            registered image is written to 2_Registered (read by stitching and formatting) and released.
+            Projections are written to 1_Projected only with `write_projected`.
+            Returns the paths of the registered images.
+        """
+        position = 'FOV{:03d}'.format(fov)
+        with measure('MIP', fov=fov):
+            projections = self.project_fov(fov)
+        if self.write_projected:
+            makedirs(path.join(self.dir_output_Projected, position), exist_ok=True)
+            for (rnd, channel_int), max_array in projections.items():
+                tiff.imsave(path.join(self.dir_output_Projected, position, mip_name(rnd, fov, channel_int)), max_array)
+
+        session = myAligner.RegistrationSession(
+            destinationImagesFolder=path.join(self.dir_output_Projected, position),
+            destinationMatchingChannel=self.channel_DIC_reference,
+            imagesPosition=position,
+            destinationCycle=self.cycle_reference,
+            destinationImage=projections[(self.cycle_reference, self.channel_DIC_reference)])
+
+        registered = []
+        result_dir = path.join(self.dir_output_aligned, position)
+        for rnd in self.rnd_list:
+            logger.info(position + ', cycle ' + rnd + ' started to align')
+            origin_images = {channel_int: max_array for (r, channel_int), max_array in projections.items() if r == rnd}
+            with measure('register', fov=fov, rnd=rnd):
+                aligned = session.alignImages(
+                    originImages=origin_images,
+                    originMatchingChannel=self.channel_DIC if rnd not in self.cycle_other else self.channel_DIC_other[rnd],
+                    originCycle=rnd,
+                    resultDirectory=result_dir,
+                    MaximumNumberOfIterations=400,
+                    numberOfThreads=self.elastix_threads,
+                    preRegistration=self.aligner_options['preRegistration'],
+                    translationOnlyPeak=self.aligner_options['translationOnlyPeak'],
+                    useTransformCache=self.aligner_options['useTransformCache'])
+                # the same writer as the file-based registration, so both modes write the same files
+                for channel_int, result_image in aligned.items():
+                    registered.append(path.join(result_dir, mip_name(rnd, fov, channel_int)))
+                    myAligner.writeResultImage(result_image, registered[-1],
+                                               outputPixelType=self.aligner_options['outputPixelType'],
+                                               outputCompression=self.aligner_options['outputCompression'])
+            # the projections and registered images of the round are not needed any more
+            del aligned, origin_images
+            for key in [key for key in projections if key[0] == rnd]:
+                del projections[key]
+        return registered
+
+    def run_fused(self):
+        """ Fused per-FOV MIP + registration of all FOVs, on `self.workers` processes.
+            Only the paths of the registered images come back, so memory does not grow with the FOVs;
+            the time of each FOV is in its 'MIP' and 'register' metrics.
+            Returns the paths of the registered images of every FOV.
+        """
+        registered = []
+        if self.workers <= 1:
+            for fov in range(self.n_fovs):
+                registered.extend(self.project_and_align_fov(fov))
+                logger.info('FOV{0:03d} projected and aligned'.format(fov))
+            return registered
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.project_and_align_fov, fov): fov for fov in range(self.n_fovs)}
+            for future in as_completed(futures):
+                registered.extend(future.result())
+                logger.info('FOV{0:03d} projected and aligned'.format(futures[future]))
+        return registered
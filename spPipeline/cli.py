@@ -1,120 +1,369 @@
-import os
-import re
-import argparse
-from starfish.types import Axes
-from spPipeline.codebookGenerator import create_jsoncodebook
-from spPipeline.align import *
-from spPipeline.StitchDriver import Stitch
-from spPipeline.toStarfishFormat import format_data
-from spPipeline.starfishDecode import *
-from spPipeline.combineFOVs import combine_fovs
-from spPipeline.segmentation import segmentation
-
-# arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-r", "--raw", default="../0_Raw", help="input dir contains Raw files")
-parser.add_argument("-o", "--output", default="./", help="output dir")
-parser.add_argument("-s", "--sigma", default=0.7, type=float,
-                    help="sigma for gaussian filter")
-parser.add_argument("-rd", "--rnd_list",
-                    default=["0_anchor", "1_dc0", "2_dc1", "3_dc2", "4_dc3", "5_dc4", "6_dc5", "7_DRAQ5"],
-                    type=list,
-                    help="list of decoding cycle rounds")
-parser.add_argument("-nf", "--nfovs", default=80, type=int, help="number of fov (filed of view)")
-parser.add_argument("-cr", "--channel_DIC_reference", default='ch03',
-                    help="DIC channel for reference cycle")
-parser.add_argument("-cd", "--channel_DIC", default='ch03',
-                    help="DIC channel for (non-reference) decoding cycles")
-parser.add_argument("-co", "--cycle_other", type=list, default=['0_anchor', '7_DRAQ5'],
-                    help="other data-containing folders which need to be aligned but are not names 'CycleXX'")
-parser.add_argument("-cdo", "--channel_DIC_other", default={'0_anchor': 'ch01', '7_DRAQ5': 'ch01'},
-                    help="DIC channel for other data-containing folders")
-parser.add_argument("-gx", "--grid_size_x", type=int, default=8,
-                    help="grid size (x-axis) for each tile")
-parser.add_argument("-gy", "--grid_size_y", type=int, default=10,
-                    help="grid size (y-axis) for each tile")
-parser.add_argument("-to", "--tile_overlap", type=int, default=15,
-                    help="overlap for each tile")
-parser.add_argument("-ij", "--ij_path", default="/home/qiwenhu/software/Fiji.app/ImageJ-linux64",
-                    help="The path to imagej’s executables")
-parser.add_argument("-sr", "--stitchRef", default="dc3",
-                    help="The round to be used as the reference for stitching")
-
-args = parser.parse_args()
-
-
-def main():
-    # Synthesizing codebook
-    cycle_reference = args.rnd_list[round(len(args.rnd_list) / 2)]
-    barcode_file = os.path.join(args.output, '_codebook/TB12k_Mar2018_V7_noAnchor.txt')
-    codebook_file = os.path.join(args.output, '_codebook/TB12k_Mar2018_V7_noAnchor.json')
-
-    create_jsoncodebook(infilepath=barcode_file, outfilepath=codebook_file,
-                        totalCycles=6, offCycles=2, firstCycleAnchor=False,
-                        addEmptyBarcodes=True, uniColorAllowed=False)
-
-    # image align and maximum projection
-    image_align = ImageAlign(raw_dir=args.raw, output_dir=args.output,
-                             rnd_list=args.rnd_list, n_fovs=args.nfovs, sigma=args.sigma,
-                             channel_DIC_reference=args.channel_DIC_reference,
-                             channel_DIC=args.channel_DIC, cycle_other=args.cycle_other,
-                             channel_DIC_other=args.channel_DIC_other)
-    image_align.get_maximum_intensity()
-    image_align.dimension_align_2d()
-
-    # stitching
-    input_dir = os.path.join(args.output, "2_Registered")
-    stitch_dir = os.path.join(args.output, "2_Registered/stitched")
-    rounds = [re.sub(r'\d_', r"", i) for i in args.rnd_list]
-    stitchChRef = args.channel_DIC_reference
-    image_stitching = Stitch(input_dir=input_dir, stitch_dir=stitch_dir, rounds=rounds,
-                             stitchRef=args.stitchRef, stitchChRef=stitchChRef,
-                             grid_size_x=args.grid_size_x, grid_size_y=args.grid_size_y,
-                             tileOverlap=args.tile_overlap, ij_path=args.ij_path)
-    image_stitching.stitch_reference()
-    image_stitching.stitch_tileconfig()
-    image_stitching.generate_cvs()
-
-    # converting to starfish format
-    SHAPE = {Axes.Y: 1024, Axes.X: 1024}
-    VOXEL = {"Y": 0.144, "X": 0.144, "Z": 0.420}
-
-    RND_LIST = args.rnd_list[1:]
-    RND_ALIGNED = RND_LIST[round(len(RND_LIST) / 2) - 1]
-    RND_DRAQ5 = RND_LIST[-1]
-
-    decode_dir = os.path.join(args.output, "3_Decoded/data_Starfish")
-    codebook_path = os.path.join(args.output, "_codebook", "TB12k_Mar2018_V7_noAnchor.json")
-    if not os.path.exists(codebook_path):
-        raise FileNotFoundError("Codebook Not Found.")
-    if not os.path.exists(decode_dir):
-        os.makedirs(decode_dir)
-    format_data(input_dir, decode_dir, fov_count=args.nfovs, SHAPE=SHAPE,
-                voxel=VOXEL, rnd_list=RND_LIST, rnd_aligned=RND_ALIGNED, rnd_draq5=RND_DRAQ5,
-                codebook_path=codebook_path, rounds=6, channels=3, zplanes=1)
-
-    # starfish decoding
-    output_dir = os.path.join(args.output, "3_Decoded/output_Starfish")
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    starfish_decode(output_dir=output_dir, decode_dir=decode_dir,
-                    magnitude_thresholds=[2.0], area_threshold=(5, 100),
-                    distance_threshold=3, normalize=True)
-    starfish_decode(output_dir=output_dir, decode_dir=decode_dir,
-                    magnitude_thresholds=[0.9], area_threshold=(5, 100),
-                    distance_threshold=3, normalize=False)
-
-    # Pooling rolonies from all FOVs and filtering
-    combine_fovs(decoding_dir=output_dir, voxel=VOXEL, emptyFractionThresh=0.12)
-
-    # cell segmentation
-    nuc_path = os.path.join(args.output, "2_Registered/stitched/MIP_7_DRAQ5_ch00.tif")
-    saving_path = os.path.join(args.output, '4_CellAssignment')
-    bcmag = 'bcmag2.0'
-    spot_file = os.path.join(args.output, '3_Decoded/output_Starfish/{}/all_spots_filtered.tsv'.format(bcmag))
-    segmentation(nuc_path, saving_path, bcmag, spot_file)
-
-
-
-
+import os
+import re
+import argparse
+from starfish.types import Axes
+from spPipeline.codebookGenerator import create_jsoncodebook
+from spPipeline.align import *
+from spPipeline.StitchDriver import Stitch
+from spPipeline.toStarfishFormat import format_data
+from spPipeline.starfishDecode import *
+from spPipeline.combineFOVs import combine_fovs
+from spPipeline.segmentation import segmentation
+from spPipeline.scheduler import TaskGraph
+from spPipeline.manifest import RunManifest, run_and_hash
+from spPipeline.metrics import measure, set_metrics_file, print_summary
+from spPipeline.stageLogging import setup_console
+
+# arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("-r", "--raw", default="../0_Raw", help="input dir contains Raw files")
+parser.add_argument("-o", "--output", default="./", help="output dir")
+parser.add_argument("-s", "--sigma", default=0.7, type=float,
+                    help="sigma for gaussian filter")
+parser.add_argument("-rd", "--rnd_list",
+                    default=["0_anchor", "1_dc0", "2_dc1", "3_dc2", "4_dc3", "5_dc4", "6_dc5", "7_DRAQ5"],
+                    type=list,
+                    help="list of decoding cycle rounds")
+parser.add_argument("-nf", "--nfovs", default=80, type=int, help="number of fov (filed of view)")
+parser.add_argument("-cr", "--channel_DIC_reference", default='ch03',
+                    help="DIC channel for reference cycle")
+parser.add_argument("-cd", "--channel_DIC", default='ch03',
+                    help="DIC channel for (non-reference) decoding cycles")
+parser.add_argument("-co", "--cycle_other", type=list, default=['0_anchor', '7_DRAQ5'],
+                    help="other data-containing folders which need to be aligned but are not names 'CycleXX'")
+parser.add_argument("-cdo", "--channel_DIC_other", default={'0_anchor': 'ch01', '7_DRAQ5': 'ch01'},
+                    help="DIC channel for other data-containing folders")
+parser.add_argument("-gx", "--grid_size_x", type=int, default=8,
+                    help="grid size (x-axis) for each tile")
+parser.add_argument("-gy", "--grid_size_y", type=int, default=10,
+                    help="grid size (y-axis) for each tile")
+parser.add_argument("-to", "--tile_overlap", type=int, default=15,
+                    help="overlap for each tile")
+parser.add_argument("-ij", "--ij_path", default="/home/qiwenhu/software/Fiji.app/ImageJ-linux64",
+                    help="The path to imagej’s executables")
+parser.add_argument("-sr", "--stitchRef", default="dc3",
+                    help="The round to be used as the reference for stitching")
+parser.add_argument("-w", "--workers", type=int, default=1,
+                    help="number of worker processes for the parallel stages")
+parser.add_argument("-zb", "--z_block", type=int, default=None,
+                    help="z-planes per vectorized gaussian block in the MIP (default: plane by plane)")
+parser.add_argument("-et", "--elastix_threads", type=int, default=None,
+                    help="elastix threads per registration worker (default: cores / workers)")
+parser.add_argument("-pr", "--pre_registration", action="store_true",
+                    help="seed the affine registration with an FFT phase-correlation translation")
+parser.add_argument("-tp", "--translation_only_peak", type=float, default=None,
+                    help="phase-correlation peak above which the translation is used without elastix")
+parser.add_argument("-nc", "--no_transform_cache", action="store_true",
+                    help="recompute all registration transforms instead of reusing cached ones")
+parser.add_argument("-rt", "--registered_dtype", default='uint8', choices=['uint8', 'uint16', 'float32'],
+                    help="pixel type of the registered images (float32: the uint16 range scaled to [0, 1], "
+                         "as starfish expects of float images)")
+parser.add_argument("-rc", "--registered_compression", default=0, choices=list(range(10)) + ['lzma'],
+                    type=lambda value: value if value == 'lzma' else int(value),
+                    help="zlib level (0-9) or lzma compression of the uint16/float32 registered images")
+parser.add_argument("-nr", "--native_range_decode", action="store_true",
+                    help="decode the registered images in their native range, divided by one scale per FOV (the median "
+                         "image maximum) instead of expanding every image, so the thresholds keep their meaning")
+parser.add_argument("-fu", "--fused", action="store_true",
+                    help="project and register each FOV in memory, without writing and reading back the projections")
+parser.add_argument("-wp", "--write_projected", action="store_true",
+                    help="in fused mode, also write the projections to 1_Projected")
+parser.add_argument("-sc", "--scheduler", action="store_true",
+                    help="run the stages as a per-FOV task graph on the worker pool instead of stage by stage")
+parser.add_argument("-re", "--resume", action="store_true",
+                    help="skip the units of work the run manifest records as complete (implies --scheduler)")
+parser.add_argument("-mt", "--multi_threshold", action="store_true",
+                    help="decode the magnitude thresholds sharing a normalization setting from one filtered stack")
+parser.add_argument("-mh", "--magnitude_histograms", action="store_true",
+                    help="write a histogram of the pixel magnitudes of every FOV (diagnostic)")
+parser.add_argument("-de", "--decoder", choices=['starfish', 'numpy'], default='starfish',
+                    help="pixel decoder: starfish's PixelSpotDecoder or the in-project NumPy decoder")
+parser.add_argument("-dt", "--decode_tile_size", type=int, default=None,
+                    help="decode every FOV in overlapping tiles of this many pixels to bound memory")
+parser.add_argument("-dp", "--decode_precision", choices=['float32', 'float64'], default='float32',
+                    help="precision of the numpy decoder")
+parser.add_argument("-pv", "--precision_report", type=int, nargs='+', default=[],
+                    help="FOVs to also decode in both float32 and float64, reporting how their spot calls differ")
+parser.add_argument("-sf", "--spot_format", choices=['csv', 'parquet'], default='csv',
+                    help="format of the decoded spot tables of the FOVs")
+parser.add_argument("-dd", "--dedup_engine", choices=['loop', 'kdtree'], default='loop',
+                    help="deduplication of the rolonies of overlapping FOVs: per gene and FOV, or one KD-tree pass")
+
+args = parser.parse_args()
+
+
+# converting to starfish format
+SHAPE = {Axes.Y: 1024, Axes.X: 1024}
+VOXEL = {"Y": 0.144, "X": 0.144, "Z": 0.420}
+# (magnitude threshold, normalize) of the two decoding passes
+DECODE_PASSES = [(2.0, True), (0.9, False)]
+
+
+def make_codebook():
+    # Synthesizing codebook
+    barcode_file = os.path.join(args.output, '_codebook/TB12k_Mar2018_V7_noAnchor.txt')
+    codebook_file = os.path.join(args.output, '_codebook/TB12k_Mar2018_V7_noAnchor.json')
+
+    with measure('codebook'):
+        create_jsoncodebook(infilepath=barcode_file, outfilepath=codebook_file,
+                            totalCycles=6, offCycles=2, firstCycleAnchor=False,
+                            addEmptyBarcodes=True, uniColorAllowed=False)
+
+
+def make_image_align():
+    return ImageAlign(raw_dir=args.raw, output_dir=args.output,
+                      rnd_list=args.rnd_list, n_fovs=args.nfovs, sigma=args.sigma,
+                      channel_DIC_reference=args.channel_DIC_reference,
+                      channel_DIC=args.channel_DIC, cycle_other=args.cycle_other,
+                      channel_DIC_other=args.channel_DIC_other, workers=args.workers,
+                      z_block=args.z_block, elastix_threads=args.elastix_threads,
+                      pre_registration=args.pre_registration,
+                      translation_only_peak=args.translation_only_peak,
+                      transform_cache=not args.no_transform_cache,
+                      registered_dtype=args.registered_dtype,
+                      registered_compression=args.registered_compression,
+                      write_projected=args.write_projected)
+
+
+def stitch_images():
+    input_dir = os.path.join(args.output, "2_Registered")
+    stitch_dir = os.path.join(args.output, "2_Registered/stitched")
+    rounds = [re.sub(r'\d_', r"", i) for i in args.rnd_list]
+    stitchChRef = args.channel_DIC_reference
+    image_stitching = Stitch(input_dir=input_dir, stitch_dir=stitch_dir, rounds=rounds,
+                             stitchRef=args.stitchRef, stitchChRef=stitchChRef,
+                             grid_size_x=args.grid_size_x, grid_size_y=args.grid_size_y,
+                             tileOverlap=args.tile_overlap, ij_path=args.ij_path)
+    with measure('stitch'):
+        image_stitching.stitch_reference()
+        image_stitching.stitch_tileconfig()
+        image_stitching.generate_cvs()
+
+
+def format_images():
+    input_dir = os.path.join(args.output, "2_Registered")
+    RND_LIST = args.rnd_list[1:]
+    RND_ALIGNED = RND_LIST[round(len(RND_LIST) / 2) - 1]
+    RND_DRAQ5 = RND_LIST[-1]
+
+    decode_dir = os.path.join(args.output, "3_Decoded/data_Starfish")
+    codebook_path = os.path.join(args.output, "_codebook", "TB12k_Mar2018_V7_noAnchor.json")
+    if not os.path.exists(codebook_path):
+        raise FileNotFoundError("Codebook Not Found.")
+    if not os.path.exists(decode_dir):
+        os.makedirs(decode_dir)
+    with measure('format'):
+        format_data(input_dir, decode_dir, fov_count=args.nfovs, SHAPE=SHAPE,
+                    voxel=VOXEL, rnd_list=RND_LIST, rnd_aligned=RND_ALIGNED, rnd_draq5=RND_DRAQ5,
+                    codebook_path=codebook_path, rounds=6, channels=3, zplanes=1)
+
+
+def decode_dirs():
+    """ (starfish experiment dir, decoding output dir) """
+    output_dir = os.path.join(args.output, "3_Decoded/output_Starfish")
+    os.makedirs(output_dir, exist_ok=True)
+    return os.path.join(args.output, "3_Decoded/data_Starfish"), output_dir
+
+
+def decode_groups():
+    """ [(normalize, [magnitude thresholds])] decoded together: with --multi_threshold the passes sharing
+        a normalization setting share one filtered and decoded stack, otherwise every pass is on its own
+    """
+    if not args.multi_threshold:
+        return [(normalize, [magnitude_threshold]) for magnitude_threshold, normalize in DECODE_PASSES]
+    groups = {}
+    for magnitude_threshold, normalize in DECODE_PASSES:
+        groups.setdefault(normalize, []).append(magnitude_threshold)
+    return list(groups.items())
+
+
+def decode_images():
+    decode_dir, output_dir = decode_dirs()
+    with measure('decode'):
+        for normalize, magnitude_thresholds in decode_groups():
+            starfish_decode(output_dir=output_dir, decode_dir=decode_dir,
+                            magnitude_thresholds=magnitude_thresholds, area_threshold=(5, 100),
+                            distance_threshold=3, normalize=normalize,
+                            expand_dynamic_range=not args.native_range_decode, workers=args.workers,
+                            multi_threshold=args.multi_threshold,
+                            magnitude_histograms=args.magnitude_histograms, decoder=args.decoder,
+                            tile_size=args.decode_tile_size, precision=args.decode_precision,
+                            table_format=args.spot_format)
+            for fov in args.precision_report:
+                write_precision_report(decode_dir, output_dir, fov, magnitude_thresholds, normalize,
+                                       area_threshold=(5, 100), distance_threshold=3,
+                                       expand_dynamic_range=not args.native_range_decode)
+
+
+def decode_image_fov(fov, magnitude_thresholds, normalize):
+    decode_dir, output_dir = decode_dirs()
+    histogram_dir = None
+    if args.magnitude_histograms:
+        histogram_dir = os.path.join(output_dir, 'magnitude_histograms')
+        os.makedirs(histogram_dir, exist_ok=True)
+    decode_fov(decode_dir, output_dir, fov, magnitude_thresholds, normalize,
+               area_threshold=(5, 100), distance_threshold=3,
+               expand_dynamic_range=not args.native_range_decode, multi_threshold=args.multi_threshold,
+               histogram_dir=histogram_dir, decoder=args.decoder, tile_size=args.decode_tile_size,
+               precision=args.decode_precision, table_format=args.spot_format)
+    if fov in args.precision_report:
+        write_precision_report(decode_dir, output_dir, fov, magnitude_thresholds, normalize,
+                               area_threshold=(5, 100), distance_threshold=3,
+                               expand_dynamic_range=not args.native_range_decode)
+
+
+def combine_images():
+    # Pooling rolonies from all FOVs and filtering
+    with measure('combine'):
+        combine_fovs(decoding_dir=os.path.join(args.output, "3_Decoded/output_Starfish"),
+                     voxel=VOXEL, emptyFractionThresh=0.12, table_format=args.spot_format,
+                     workers=args.workers, dedup_engine=args.dedup_engine)
+
+
+def segment_cells():
+    nuc_path = os.path.join(args.output, "2_Registered/stitched/MIP_7_DRAQ5_ch00.tif")
+    saving_path = os.path.join(args.output, '4_CellAssignment')
+    bcmag = 'bcmag2.0'
+    spot_file = os.path.join(args.output, '3_Decoded/output_Starfish/{}/all_spots_filtered.tsv'.format(bcmag))
+    with measure('segmentation'):
+        segmentation(nuc_path, saving_path, bcmag, spot_file)
+
+
+def add_unit(graph, manifest, name, func, *func_args, inputs=(), raw_inputs=(), outputs=(), params=None, deps=()):
+    """ adds `func` to the graph as a checkpointed unit of work: its outputs are hashed by the task itself,
+        it is recorded in the run manifest once done, and with --resume it is skipped if its manifest
+        entry is still valid. `raw_inputs` (the raw z-planes) are checked by size and modification time.
+    """
+    params = params or {}
+    skip = None
+    if args.resume:
+        skip = lambda: manifest.is_complete(name, inputs, params, raw_inputs)
+    return graph.add(name, run_and_hash, func, outputs, *func_args, deps=deps, skip=skip,
+                     on_done=lambda result: manifest.record(name, inputs, params, result[1], raw_inputs))
+
+
+def run_scheduled():
+    """ Runs the pipeline as a task graph on `args.workers` processes: each FOV goes through
+        MIP -> registration and, once the experiment is formatted, decoding on its own, and only
+        stitching, formatting, combining and segmentation wait for every FOV.
+        Every unit is checkpointed in the run manifest (see `RunManifest`), so that --resume
+        continues from the first incomplete one.
+    """
+    image_align = make_image_align()
+    manifest = RunManifest(args.output)
+    graph = TaskGraph()
+
+    codebook_dir = os.path.join(args.output, '_codebook')
+    codebook_file = os.path.join(codebook_dir, 'TB12k_Mar2018_V7_noAnchor.json')
+    add_unit(graph, manifest, 'codebook', make_codebook,
+             inputs=[os.path.join(codebook_dir, 'TB12k_Mar2018_V7_noAnchor.txt')], outputs=[codebook_file])
+
+    mip_params = {'sigma': args.sigma, 'z_block': args.z_block}
+    align_params = {'rnd_list': args.rnd_list, 'cycle_reference': image_align.cycle_reference,
+                    'channel_DIC_reference': args.channel_DIC_reference, 'channel_DIC': args.channel_DIC,
+                    'cycle_other': args.cycle_other, 'channel_DIC_other': args.channel_DIC_other,
+                    'aligner_options': image_align.aligner_options}
+    registered = []
+    registered_files = []
+    for fov in range(args.nfovs):
+        registered_fov = image_align.mip_paths(image_align.dir_output_aligned, fov)
+        registered_files.extend(registered_fov)
+        if args.fused:
+            registered.append(add_unit(graph, manifest, 'register FOV{:03d}'.format(fov),
+                                       image_align.project_and_align_fov, fov,
+                                       raw_inputs=image_align.raw_paths(fov), outputs=registered_fov,
+                                       params=dict(mip_params, **align_params)))
+        else:
+            projected_fov = image_align.mip_paths(image_align.dir_output_Projected, fov)
+            mip = add_unit(graph, manifest, 'MIP FOV{:03d}'.format(fov), image_align.get_maximum_intensity_fov, fov,
+                           raw_inputs=image_align.raw_paths(fov), outputs=projected_fov, params=mip_params)
+            registered.append(add_unit(graph, manifest, 'register FOV{:03d}'.format(fov), image_align.align_fov, fov,
+                                       inputs=projected_fov, outputs=registered_fov, params=align_params,
+                                       deps=[mip]))
+
+    stitch_dir = os.path.join(args.output, "2_Registered/stitched")
+    add_unit(graph, manifest, 'stitch', stitch_images, inputs=registered_files, outputs=[stitch_dir],
+             params={'stitchRef': args.stitchRef, 'grid_size_x': args.grid_size_x,
+                     'grid_size_y': args.grid_size_y, 'tile_overlap': args.tile_overlap},
+             deps=registered)
+
+    decode_dir, output_dir = decode_dirs()
+    format_inputs = registered_files + [os.path.join(stitch_dir, "registration_reference_coordinates.csv"),
+                                        codebook_file]
+    add_unit(graph, manifest, 'format', format_images, inputs=format_inputs, outputs=[decode_dir],
+             deps=['stitch', 'codebook'])
+
+    decoded = []
+    decoded_files = []
+    spot_files = []
+    for magnitude_threshold, normalize in DECODE_PASSES:
+        spot_files.append(os.path.join(output_dir, "bcmag{}".format(magnitude_threshold), 'all_spots_filtered.tsv'))
+    for normalize, magnitude_thresholds in decode_groups():
+        for fov in range(args.nfovs):
+            tables = [decoded_table_path(os.path.join(output_dir, "bcmag{}".format(magnitude_threshold)),
+                                         magnitude_threshold, fov, args.spot_format)
+                      for magnitude_threshold in magnitude_thresholds]
+            decoded_files.extend(tables)
+            decoded.append(add_unit(graph, manifest, 'decode bcmag{} FOV{:03d}'.format(
+                                        '+'.join(str(t) for t in magnitude_thresholds), fov),
+                                    decode_image_fov, fov, magnitude_thresholds, normalize,
+                                    inputs=[decode_dir], outputs=tables,
+                                    params={'normalize': normalize,
+                                            'expand_dynamic_range': not args.native_range_decode,
+                                            'decoder': args.decoder, 'tile_size': args.decode_tile_size,
+                                            'precision': args.decode_precision},
+                                    deps=['format']))
+    add_unit(graph, manifest, 'combine', combine_images, inputs=decoded_files, outputs=spot_files,
+             params={'emptyFractionThresh': 0.12, 'table_format': args.spot_format,
+                     'dedup_engine': args.dedup_engine}, deps=decoded)
+    add_unit(graph, manifest, 'segmentation', segment_cells,
+             inputs=[os.path.join(args.output, "2_Registered/stitched/MIP_7_DRAQ5_ch00.tif"), spot_files[0]],
+             outputs=[os.path.join(args.output, '4_CellAssignment')], deps=['combine'])
+    graph.run(workers=args.workers)
+
+
+def main():
+    # progress on stdout; the stages log to their own files in the output directories
+    setup_console()
+    # timing and memory of every stage and FOV, summarized at the end of the run
+    metrics_file = os.path.join(args.output, '_metrics.jsonl')
+    set_metrics_file(metrics_file)
+    if args.scheduler or args.resume:
+        with measure('pipeline'):
+            run_scheduled()
+        print_summary(metrics_file)
+        return
+
+    make_codebook()
+
+    # image align and maximum projection
+    image_align = make_image_align()
+    if args.fused:
+        with measure('MIP+register'):
+            image_align.run_fused()
+    else:
+        with measure('MIP'):
+            image_align.get_maximum_intensity()
+        with measure('register'):
+            image_align.dimension_align_2d()
+
+    # stitching
+    stitch_images()
+
+    # converting to starfish format
+    format_images()
+
+    # starfish decoding
+    decode_images()
+
+    # Pooling rolonies from all FOVs and filtering
+    combine_images()
+
+    # cell segmentation
+    segment_cells()
+
+    print_summary(metrics_file)
+
+
+
+
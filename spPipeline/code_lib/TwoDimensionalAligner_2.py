@@ -5,39 +5,245 @@ import sys
 #sitkPath = ''
 #sys.path.insert(1, sitkPath)
 import SimpleITK as sitk
-import os, re
+import numpy as np
+import os, re, shutil, hashlib, logging
 from os.path import join as pathjoin
-from datetime import datetime
+from spPipeline.imageIO import write_image
+
+logger = logging.getLogger(__name__)
+
+
+def asImage2D(image):
+    """ a 2D SimpleITK image from a SimpleITK image or a numpy array """
+    return image if isinstance(image, sitk.Image) else sitk.GetImageFromArray(image)
+
+
+def readImage2D(imageFiles):
+    """ reads the image file(s) as a 3D image and extracts its first z-slice """
+    image3D = sitk.ReadImage(imageFiles)
+    return sitk.Extract(image3D, (image3D.GetWidth(), image3D.GetHeight(), 0), (0,0,0))
+
+
+def phaseCorrelation(fixedArray, movingArray):
+    """ Estimates the translation between two 2D arrays by FFT phase correlation.
+        Returns (shift_x, shift_y, peak): the content of movingArray is shifted by (shift_x, shift_y) pixels
+        relative to fixedArray, and peak (0 to 1) is the height of the normalized correlation peak:
+        a few hundredths when there is no match, and growing with the confidence of the translation.
+    """
+    window = np.outer(np.hanning(fixedArray.shape[0]), np.hanning(fixedArray.shape[1])).astype(np.float32) # reduces the edge effects of the FFT
+    fixed = (fixedArray - fixedArray.mean()).astype(np.float32) * window
+    moving = (movingArray - movingArray.mean()).astype(np.float32) * window
+
+    crossPower = np.fft.rfft2(moving) * np.conj(np.fft.rfft2(fixed))
+    crossPower /= np.abs(crossPower) + np.finfo(np.float32).eps
+    correlation = np.fft.irfft2(crossPower, s=fixed.shape)
+
+    peakY, peakX = np.unravel_index(np.argmax(correlation), correlation.shape)
+    peak = correlation[peakY, peakX]
+
+    def subpixel(values, i):
+        """ parabolic refinement of the peak position along one axis """
+        left, centre, right = values[i - 1], values[i], values[(i + 1) % len(values)]
+        denominator = left - 2 * centre + right
+        return i + (0.5 * (left - right) / denominator if denominator != 0 else 0.0)
+
+    shiftY = subpixel(correlation[:, peakX], peakY)
+    shiftX = subpixel(correlation[peakY, :], peakX)
+    # shifts past the middle wrap around to negative shifts
+    if shiftY > fixed.shape[0] / 2:
+        shiftY -= fixed.shape[0]
+    if shiftX > fixed.shape[1] / 2:
+        shiftX -= fixed.shape[1]
+    return float(shiftX), float(shiftY), float(peak)
+
+
+def parameterMapToTransform(parameterMap):
+    """ SimpleITK transform equivalent to an elastix translation or affine transform parameter map,
+        including the initial transforms it is composed with; None if a transform of the chain is of another kind
+    """
+    transformName = parameterMap['Transform'][0]
+    transformParameters = [float(x) for x in parameterMap['TransformParameters']]
+    if transformName == 'TranslationTransform':
+        transform = sitk.TranslationTransform(2, transformParameters)
+    elif transformName == 'AffineTransform':
+        center = [float(x) for x in parameterMap['CenterOfRotationPoint']]
+        transform = sitk.AffineTransform(transformParameters[:4], transformParameters[4:], center) # elastix order: a11, a12, a21, a22, tx, ty
+    else:
+        return None
+
+    initialTransformFile = parameterMap['InitialTransformParametersFileName'][0]
+    if initialTransformFile == 'NoInitialTransform':
+        return transform
+    if parameterMap['HowToCombineTransforms'][0] != 'Compose':
+        return None
+    initialTransform = parameterMapToTransform(sitk.ReadParameterFile(initialTransformFile))
+    if initialTransform is None:
+        return None
+    # elastix applies the initial transform first; composite transforms apply the last added one first
+    if hasattr(sitk, 'CompositeTransform'):
+        composite = sitk.CompositeTransform(2)
+    else:
+        composite = sitk.Transform(2, sitk.sitkIdentity)
+    composite.AddTransform(transform)
+    composite.AddTransform(initialTransform)
+    return composite
+
+
+def parameterMapToResampler(parameterMap):
+    """ a resampler applying the transform of an elastix transform parameter map on the destination grid,
+        like transformix does; None if the transform can't be converted
+    """
+    transform = parameterMapToTransform(parameterMap)
+    if transform is None:
+        return None
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize([int(x) for x in parameterMap['Size']])
+    resampler.SetOutputSpacing([float(x) for x in parameterMap['Spacing']])
+    resampler.SetOutputOrigin([float(x) for x in parameterMap['Origin']])
+    resampler.SetOutputDirection([float(x) for x in parameterMap['Direction']])
+    resampler.SetTransform(transform)
+    order = int(parameterMap['FinalBSplineInterpolationOrder'][0])
+    resampler.SetInterpolator({0: sitk.sitkNearestNeighbor, 1: sitk.sitkLinear}.get(order, sitk.sitkBSpline))
+    resampler.SetDefaultPixelValue(float(parameterMap['DefaultPixelValue'][0]))
+    resampler.SetOutputPixelType(sitk.sitkFloat32) # transformix results are float as well
+    return resampler
+
+
+def makeImageTransform(transformParameterMap, batchResampling = True):
+    """ returns a function applying an elastix transform parameter map to a 2D image.
+        Translation and affine maps are converted once to a SimpleITK transform and every image goes
+        through the same resampler; other transforms are applied with transformix, image by image.
+    """
+    transformParameterMap[0]['FinalBSplineInterpolationOrder'] = ['1']
+    resampler = parameterMapToResampler(transformParameterMap[0]) if batchResampling else None
+    if resampler is not None:
+        return resampler.Execute
+
+    transformixImageFilter = sitk.TransformixImageFilter() 
+    transformixImageFilter.SetTransformParameterMap(transformParameterMap) # object transformixImageFilter is now ready to transform images with feed to it.
+    def transformix(image):
+        transformixImageFilter.SetMovingImage(image)
+        transformixImageFilter.Execute()
+        return transformixImageFilter.GetResultImage()
+    return transformix
+
+
+def resultImageToArray(resultImage, outputPixelType = 'uint8'):
+    """ registered (float) image as a numpy array of `outputPixelType`, the same pixels that are written to disk.
+        float32 images are the uint16 range scaled to [0, 1]: starfish expects float tiles in [0, 1] (and
+        scales uint16 tiles the same way), its filters clip to that range
+    """
+    if outputPixelType == 'uint8':
+        return sitk.GetArrayFromImage(sitk.Cast(resultImage, sitk.sitkUInt8))
+    resultArray = np.clip(sitk.GetArrayViewFromImage(resultImage), 0, np.iinfo(np.uint16).max)
+    if outputPixelType == 'uint16':
+        return np.rint(resultArray).astype(np.uint16)
+    return (resultArray / np.iinfo(np.uint16).max).astype(np.float32)
+
+
+def writeResultImage(resultImage, imagePath, outputPixelType = 'uint8', outputCompression = 0):
+    """ writes a registered (float) image in `outputPixelType`; uint8 images are written by SimpleITK as before """
+    if outputPixelType == 'uint8':
+        sitk.WriteImage(sitk.Cast(resultImage, sitk.sitkUInt8), imagePath)
+        return
+    write_image(imagePath, resultImageToArray(resultImage, outputPixelType), compress = outputCompression)
+
+
+def transformCacheKey(destinationImage, originImage, parameterMap, **settings):
+    """ content hash of the two images, the elastix parameter map and any other registration settings """
+    sha = hashlib.sha1()
+    for image in (destinationImage, originImage):
+        array = sitk.GetArrayViewFromImage(image)
+        sha.update(str((array.shape, array.dtype.str, image.GetSpacing(), image.GetOrigin())).encode())
+        sha.update(np.ascontiguousarray(array).tobytes())
+    for key in sorted(parameterMap.keys()):
+        sha.update(str((key, tuple(parameterMap[key]))).encode())
+    sha.update(str(sorted(settings.items())).encode())
+    return sha.hexdigest()
+
+
+def translationParameterMap(image, shiftX, shiftY):
+    """ elastix transform parameter map of a translation by (shiftX, shiftY) pixels, defined on the grid of `image` """
+    spacing = image.GetSpacing()
+    parameterMap = sitk.GetDefaultParameterMap('translation')
+    parameterMap['Transform'] = ['TranslationTransform']
+    parameterMap['NumberOfParameters'] = ['2']
+    parameterMap['TransformParameters'] = [str(shiftX * spacing[0]), str(shiftY * spacing[1])] # elastix maps destination points to origin points, x -> x + shift
+    parameterMap['InitialTransformParametersFileName'] = ['NoInitialTransform']
+    parameterMap['HowToCombineTransforms'] = ['Compose']
+    parameterMap['FixedImageDimension'] = ['2']
+    parameterMap['MovingImageDimension'] = ['2']
+    parameterMap['FixedInternalImagePixelType'] = ['float']
+    parameterMap['MovingInternalImagePixelType'] = ['float']
+    parameterMap['Size'] = [str(x) for x in image.GetSize()]
+    parameterMap['Index'] = ['0', '0']
+    parameterMap['Spacing'] = [str(x) for x in spacing]
+    parameterMap['Origin'] = [str(x) for x in image.GetOrigin()]
+    parameterMap['Direction'] = [str(x) for x in image.GetDirection()]
+    parameterMap['UseDirectionCosines'] = ['true']
+    parameterMap['ResampleInterpolator'] = ['FinalBSplineInterpolator']
+    parameterMap['FinalBSplineInterpolationOrder'] = ['1']
+    parameterMap['Resampler'] = ['DefaultResampler']
+    parameterMap['DefaultPixelValue'] = ['0']
+    parameterMap['ResultImageFormat'] = ['tif']
+    parameterMap['ResultImagePixelType'] = ['float']
+    parameterMap['CompressResultImage'] = ['false']
+    return parameterMap
 
 
 class ImageTransformer:
   
-    def __init__(self, destinationImageFiles, originImageFiles):
-        self.checkDestinationImage(destinationImageFiles = destinationImageFiles)
-        self.checkOriginImage(originImageFiles = originImageFiles)
+    def __init__(self, destinationImageFiles, originImageFiles, destinationImage = None, originImage = None):
+        """ destinationImage, originImage: the 2D images if they are already in memory, e.g. read by a RegistrationSession """
+        if destinationImage is None:
+            self.checkDestinationImage(destinationImageFiles = destinationImageFiles)
+        else:
+            self.destinationImageFiles = destinationImageFiles
+            self.destinationImage = destinationImage
+        if originImage is None:
+            self.checkOriginImage(originImageFiles = originImageFiles)
+        else:
+            self.originImageFiles = originImageFiles
+            self.originImage = originImage
 
     def checkDestinationImage(self, destinationImageFiles = None):
         try:
-            sitk.ReadImage(destinationImageFiles)
+            self.destinationImage = readImage2D(destinationImageFiles) # kept, so the image is read only once
             self.destinationImageFiles = destinationImageFiles
         except:
             raise FileNotFoundError('Destination image could not be read')
 
     def checkOriginImage(self, originImageFiles = None):
         try:
-            sitk.ReadImage(originImageFiles)
+            self.originImage = readImage2D(originImageFiles) # kept, so the image is read only once
             self.originImageFiles = originImageFiles
         except:
             raise FileNotFoundError('Origin image could not be read')
 
-    def findTransformParameters(self, transform = "affine", NumberOfResolutions = 7, MaximumNumberOfIterations = 1000, NumberOfSpatialSamples = 4000):   
-        """ running elastix on destination and origin images to find the transform parameter map between them """
+    def findTransformParameters(self, transform = "affine", NumberOfResolutions = 7, MaximumNumberOfIterations = 1000, NumberOfSpatialSamples = 4000,
+                                outputDirectory = None, numberOfThreads = None, preRegistration = False, translationOnlyPeak = None,
+                                cacheDirectory = None):   
+        """ running elastix on destination and origin images to find the transform parameter map between them
+            outputDirectory: where elastix writes its log and IterationInfo files, instead of the current working directory
+            numberOfThreads: maximum number of threads elastix may use
+            preRegistration: if True, the translation found by FFT phase correlation is the initial transform of elastix
+            translationOnlyPeak: if the phase-correlation peak is at least this, the translation is the result and elastix is skipped
+            cacheDirectory: if given, transforms are stored there by a hash of both images and the parameters, and reused when they match
+        """
         self.transform = transform
         self.NumberOfResolutions = NumberOfResolutions
         self.MaximumNumberOfIterations = MaximumNumberOfIterations
         self.NumberOfSpatialSamples = NumberOfSpatialSamples
         self.elastixImageFilter = sitk.ElastixImageFilter() # The basic object to do the transformation
-		
+        if outputDirectory is not None:
+            if os.path.isdir(outputDirectory) == False:
+                os.makedirs(outputDirectory)
+            self.elastixImageFilter.SetOutputDirectory(outputDirectory) # IterationInfo files go here, so that parallel registrations don't share them
+            self.elastixImageFilter.LogToConsoleOff()
+            self.elastixImageFilter.LogToFileOn()
+        if numberOfThreads is not None:
+            self.elastixImageFilter.SetNumberOfThreads(numberOfThreads)
+
         """ Setting the transformation parameters"""        
         parameterMap = self.elastixImageFilter.GetDefaultParameterMap(self.transform) # getting the dafault parameter map for our transformation of interest
         parameterMap['NumberOfHistogramBins'] = ['64'] # a parameter for the image comparison metric, AdvancedMattesMutualInformation, that we are using.
@@ -46,22 +252,58 @@ class ImageTransformer:
         parameterMap['NumberOfSpatialSamples'] = [str(self.NumberOfSpatialSamples)] # number of random samples drawn for image comparison during optimization
         parameterMap['WriteIterationInfo'] = ['true'] # This command writes the report in the current working directory, so we have to move the files later    
 		
+        """ Reusing the transformation found in a previous run for the same images and parameters """
+        self.phaseCorrelationPeak = None
+        self.transformCacheFile = None
+        if cacheDirectory is not None:
+            cacheKey = transformCacheKey(self.readDestinationImage(), self.readOriginImage(), parameterMap,
+                                         preRegistration = preRegistration, translationOnlyPeak = translationOnlyPeak)
+            self.transformCacheFile = pathjoin(cacheDirectory, cacheKey + '.txt')
+            if os.path.isfile(self.transformCacheFile):
+                logger.info("Transform parameters read from cache " + self.transformCacheFile)
+                self.transformParameterMap = [sitk.ReadParameterFile(self.transformCacheFile)]
+                return
+
+        if preRegistration or translationOnlyPeak is not None:
+            shiftX, shiftY, self.phaseCorrelationPeak = phaseCorrelation(sitk.GetArrayViewFromImage(self.readDestinationImage()),
+                                                                         sitk.GetArrayViewFromImage(self.readOriginImage()))
+            initialMap = translationParameterMap(self.readDestinationImage(), shiftX, shiftY)
+            logger.info("Phase correlation shift ({0:.2f}, {1:.2f}), peak {2:.3f}".format(shiftX, shiftY, self.phaseCorrelationPeak))
+            if translationOnlyPeak is not None and self.phaseCorrelationPeak >= translationOnlyPeak:
+                self.transformParameterMap = [initialMap] # confident enough: the translation is the whole transform
+                self.writeTransformCache()
+                return
+            if preRegistration:
+                initialTransformFile = pathjoin(outputDirectory if outputDirectory is not None else '.', 'InitialTranslation.txt')
+                sitk.WriteParameterFile(initialMap, initialTransformFile)
+                self.elastixImageFilter.SetInitialTransformParameterFileName(initialTransformFile) # elastix starts from the translation instead of the identity
+
         self.elastixImageFilter.SetParameterMap(parameterMap) # setting the parameter map to our transformation object
         self.elastixImageFilter.SetMovingImage(self.readOriginImage()) # Setting the origin image, the one we want to transform
         self.elastixImageFilter.SetFixedImage(self.readDestinationImage()) # Setting the destination/final image
         self.elastixImageFilter.Execute()   # running the transformation
         self.transformParameterMap = self.elastixImageFilter.GetTransformParameterMap() # saving the optimized transformation parameters
+        self.writeTransformCache()
     
     
+    def writeTransformCache(self):
+        """ stores the transform in the cache; an initial transform it refers to is copied next to it """
+        if self.transformCacheFile is None:
+            return
+        os.makedirs(os.path.dirname(self.transformCacheFile), exist_ok = True)
+        transformMap = self.transformParameterMap[0]
+        initialTransformFile = transformMap['InitialTransformParametersFileName'][0]
+        if initialTransformFile != 'NoInitialTransform':
+            cachedInitialFile = os.path.splitext(self.transformCacheFile)[0] + '_initial.txt'
+            shutil.copyfile(initialTransformFile, cachedInitialFile)
+            transformMap['InitialTransformParametersFileName'] = [cachedInitialFile]
+        sitk.WriteParameterFile(transformMap, self.transformCacheFile)
+
     def readOriginImage(self):
-        origin3D = sitk.ReadImage(self.originImageFiles)
-        origin2D = sitk.Extract(origin3D, (origin3D.GetWidth(), origin3D.GetHeight(), 0), (0,0,0))
-        return(origin2D)
+        return(self.originImage)
     
     def readDestinationImage(self):
-        dest3D = sitk.ReadImage(self.destinationImageFiles)
-        dest2D = sitk.Extract(dest3D, (dest3D.GetWidth(), dest3D.GetHeight(), 0), (0,0,0))
-        return(dest2D)
+        return(self.destinationImage)
     
     def writeParameterFile(self, reportName):
         self.elastixImageFilter.WriteParameterFile(parameterMap = self.transformParameterMap[0], filename = reportName)
@@ -70,12 +312,94 @@ class ImageTransformer:
         return self.transformParameterMap
   
 
+def groupImagesByChannel(folderFiles, cycle):
+    """ groups the MIP file names of `cycle` by channel: {channel: [file names]} """
+    imagesRE = re.compile(r"MIP_(" + cycle + r")_(FOV\d+)_(ch\d+)(.tif)") # group(0) = whole string, group(1) = cycle, group(2) = position, group(3) = channel, group(4) = .tif
+    imageFiles_splitted = [imagesRE.search(filename) for filename in folderFiles]
+    imageFiles_splitted = [x for x in imageFiles_splitted if x is not None]
+    imageFiles_splitted.sort(key = lambda x : x.group(3)) # sorting the file names based on channel values
+    imageFilesByChannel = {}
+    for x in imageFiles_splitted:
+        imageFilesByChannel.setdefault(x.group(3), []).append(x.group(0))
+    return imageFilesByChannel
+
+
+class RegistrationSession():
+    """ Registration of all origin cycles of one position against the same destination (reference) cycle.
+        The destination folder is listed and the destination matching-channel image is read once per position,
+        instead of twice per origin cycle, and handed to every TwoDimensionalAligner of the position.
+        Elastix still builds the fixed-image pyramid inside each registration; SimpleElastix does not expose it.
+        With `destinationImage` (a 2D image already in memory) nothing is read, and origin cycles are
+        registered from memory with `alignImages`.
+    """
+    def __init__(self, destinationImagesFolder, destinationMatchingChannel, imagesPosition, destinationCycle,
+                 destinationImage = None):
+        self.destinationImagesFolder = destinationImagesFolder
+        self.destinationMatchingChannel = destinationMatchingChannel
+        self.imagesPosition = imagesPosition
+        self.destinationCycle = destinationCycle
+        if destinationImage is not None:
+            self.destinationImageFilesByChannel = {}
+            self.destinationImageFiles = []
+            self.destinationImage = asImage2D(destinationImage)
+            return
+
+        self.destinationImageFilesByChannel = groupImagesByChannel(os.listdir(self.destinationImagesFolder), self.destinationCycle)
+        self.destinationImageFiles = [pathjoin(self.destinationImagesFolder, dsImgFile)
+                                      for dsImgFile in self.destinationImageFilesByChannel.get(self.destinationMatchingChannel, [])]
+        try:
+            self.destinationImage = readImage2D(self.destinationImageFiles)
+        except:
+            raise FileNotFoundError('Destination image could not be read')
+
+    def align(self, originImagesFolder, originMatchingChannel, originCycle, resultDirectory, **kwargs):
+        """ aligns `originCycle` of this position to the destination cycle; kwargs go to TwoDimensionalAligner """
+        return TwoDimensionalAligner(originImagesFolder = originImagesFolder,
+                                     destinationImagesFolder = self.destinationImagesFolder,
+                                     originMatchingChannel = originMatchingChannel,
+                                     destinationMatchingChannel = self.destinationMatchingChannel,
+                                     imagesPosition = self.imagesPosition,
+                                     destinationCycle = self.destinationCycle,
+                                     originCycle = originCycle,
+                                     resultDirectory = resultDirectory,
+                                     registrationSession = self, **kwargs)
+
+    def alignImages(self, originImages, originMatchingChannel, originCycle, resultDirectory, MaximumNumberOfIterations = 500,
+                    numberOfThreads = None, preRegistration = False, translationOnlyPeak = None, useTransformCache = True,
+                    batchResampling = True):
+        """ In-memory counterpart of `align`: registers the 2D images or arrays of `originCycle` ({channel: image}) to the
+            destination image and returns the registered {channel: SimpleITK image}, to be written with `writeResultImage`.
+            Only the MetaData (transformation report, elastix logs, transform cache) is written to resultDirectory.
+        """
+        if numberOfThreads is not None:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+        metaDataDirectory = pathjoin(resultDirectory, 'MetaData')
+        if os.path.isdir(metaDataDirectory) == False:
+            os.makedirs(metaDataDirectory)
+
+        imageTransformer = ImageTransformer(destinationImageFiles = self.destinationImageFiles, originImageFiles = None,
+                                            destinationImage = self.destinationImage, originImage = asImage2D(originImages[originMatchingChannel]))
+        imageTransformer.findTransformParameters(transform = "affine", MaximumNumberOfIterations = MaximumNumberOfIterations,
+                                                 outputDirectory = pathjoin(metaDataDirectory, 'elastix_' + originCycle),
+                                                 numberOfThreads = numberOfThreads,
+                                                 preRegistration = preRegistration,
+                                                 translationOnlyPeak = translationOnlyPeak,
+                                                 cacheDirectory = os.path.abspath(pathjoin(metaDataDirectory, 'TransformCache')) if useTransformCache else None)
+        imageTransformer.writeParameterFile(reportName = pathjoin(metaDataDirectory, str(self.imagesPosition) + '_transformation report.txt'))
+
+        transformImage = makeImageTransform(imageTransformer.getTransformParameterMap(), batchResampling = batchResampling)
+        return {channel: transformImage(asImage2D(image)) for channel, image in originImages.items()}
+
+
 class TwoDimensionalAligner():
     """ Objects of this class align images taken from one "origin" cycle to images taken from "destination" cycle of the (probably) same position """
     def __init__(self, originImagesFolder, destinationImagesFolder, 
                  originMatchingChannel, destinationMatchingChannel,
-                 imagesPosition, destinationCycle, originCycle, resultDirectory, MaximumNumberOfIterations = 500):
+                 imagesPosition, destinationCycle, originCycle, resultDirectory, MaximumNumberOfIterations = 500,
+                 numberOfThreads = None, registrationSession = None, preRegistration = False, translationOnlyPeak = None,
+                 useTransformCache = True, batchResampling = True, outputPixelType = 'uint8', outputCompression = 0):
         self.originImagesFolder = originImagesFolder 
+        self.registrationSession = registrationSession # if given, the destination image is taken from it instead of being read again
         self.destinationImagesFolder = destinationImagesFolder
         self.originMatchingChannel = originMatchingChannel
         self.destinationMatchingChannel = destinationMatchingChannel
@@ -83,6 +407,19 @@ class TwoDimensionalAligner():
         self.destinationCycle = destinationCycle
         self.originCycle = originCycle
         self.MaximumNumberOfIterations = MaximumNumberOfIterations
+        self.preRegistration = preRegistration # seed elastix with an FFT phase-correlation translation
+        self.translationOnlyPeak = translationOnlyPeak # phase-correlation peak above which elastix is skipped, None always runs it
+        self.useTransformCache = useTransformCache # reuse transforms of unchanged images from resultDirectory/MetaData/TransformCache
+        # absolute, so that the cache does not depend on the working directory of the process using it
+        self.transformCacheDirectory = os.path.abspath(pathjoin(resultDirectory, 'MetaData', 'TransformCache')) if useTransformCache else None
+        self.batchResampling = batchResampling # apply translation/affine transforms with one SimpleITK resampler instead of transformix
+        if outputPixelType not in ('uint8', 'uint16', 'float32'):
+            raise ValueError("outputPixelType has to be 'uint8', 'uint16' or 'float32', not {}".format(outputPixelType))
+        self.outputPixelType = outputPixelType # 'uint8' keeps the original 8-bit output, 'uint16' and 'float32' (scaled to [0, 1]) keep the dynamic range
+        self.outputCompression = outputCompression # zlib level (0-9) or 'lzma' for the uint16/float32 outputs
+        self.numberOfThreads = numberOfThreads # limits elastix and all other SimpleITK filters of this process, None keeps the defaults
+        if self.numberOfThreads is not None:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(self.numberOfThreads)
 
         self.resultDirectory = resultDirectory
         if os.path.isdir(self.resultDirectory) == False:
@@ -98,12 +435,18 @@ class TwoDimensionalAligner():
         
     def setImageTransformer(self):
         """ This object will be our transformer from origin cycle to destination cycle """
-        print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + self.destinationImagesFolder)
+        logger.info(self.destinationImagesFolder)
         self.imageTransformer = ImageTransformer(destinationImageFiles = [pathjoin(self.destinationImagesFolder, dsImgFile) for dsImgFile in self.destinationImageFilesByChannel[self.destinationMatchingChannel]],
-                                                 originImageFiles = [pathjoin(self.originImagesFolder, ogImgFile) for ogImgFile in self.originImageFilesByChannel[self.originMatchingChannel]])
-        print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + "Finding transform parameter started")
-        self.imageTransformer.findTransformParameters(transform = "affine", MaximumNumberOfIterations = self.MaximumNumberOfIterations)
-        print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + "Finding transform parameter done")   
+                                                 originImageFiles = [pathjoin(self.originImagesFolder, ogImgFile) for ogImgFile in self.originImageFilesByChannel[self.originMatchingChannel]],
+                                                 destinationImage = self.registrationSession.destinationImage if self.registrationSession is not None else None)
+        logger.info("Finding transform parameter started")
+        self.imageTransformer.findTransformParameters(transform = "affine", MaximumNumberOfIterations = self.MaximumNumberOfIterations,
+                                                      outputDirectory = pathjoin(self.resultDirectory, 'MetaData', 'elastix_' + self.originCycle),
+                                                      numberOfThreads = self.numberOfThreads,
+                                                      preRegistration = self.preRegistration,
+                                                      translationOnlyPeak = self.translationOnlyPeak,
+                                                      cacheDirectory = self.transformCacheDirectory)
+        logger.info("Finding transform parameter done")
         
         """ Creating a directory called metadata and write transformation parameters to it """
         if os.path.isdir(pathjoin(self.resultDirectory, 'MetaData')) == False:
@@ -124,7 +467,7 @@ class TwoDimensionalAligner():
 #         relatedOriginImagesRE = re.compile(r"(Position" + self.imagesPosition + r")_z(\d+)_(ch\d+)(.tif)") # group(0) = string, group(1) = position, group(2) = z, group(3) = channel, group(4) = .tif
 #        relatedOriginImagesRE = re.compile(r"(" + self.imagesPosition + r")_z(\d+)_(ch\d+)(.tif)") # group(0) = whole string, group(1) = position, group(2) = z, group(3) = channel, group(4) = .tif
         relatedOriginImagesRE = re.compile(r"MIP_(" + self.originCycle + r")_(FOV\d+)_(ch\d+)(.tif)") # group(0) = whole string, group(1) = cycle, group(2) = position, group(3) = channel, group(4) = .tif
-        print(relatedOriginImagesRE)
+        logger.info(relatedOriginImagesRE)
         originImageFiles_splitted = [relatedOriginImagesRE.search(filename) for filename in originFolder_files]
         originImageFiles_splitted = [x for x in originImageFiles_splitted if x is not None] # name of all files in the origin directory splitted by above regex constraints
         originImageFiles_splitted.sort(key = lambda x : x.group(3)) # sorting the file names based on channel values
@@ -137,6 +480,10 @@ class TwoDimensionalAligner():
                                           if x.group(3) == channel] # selecting those names that have the same channel
             
             
+        if self.registrationSession is not None:
+            self.destinationImageFilesByChannel = self.registrationSession.destinationImageFilesByChannel
+            return
+
         """ setting up destination file addresses """
         destinationFolder_files = os.listdir(self.destinationImagesFolder) # listing all files in the destinationImagesFolder
         
@@ -155,31 +502,29 @@ class TwoDimensionalAligner():
         for channel in set([x.group(3) for x in destinationImageFiles_splitted]): # iterate over the unique entries of channels
             self.destinationImageFilesByChannel[channel] = [x.group(0) for x in destinationImageFiles_splitted 
                                           if x.group(3) == channel] # selecting those names that have the same channel
-        print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + "After input: " + str(len(self.destinationImageFilesByChannel)))
-        print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + "After input: " + str(len(self.originImageFilesByChannel)))
+        logger.info("After input: " + str(len(self.destinationImageFilesByChannel)))
+        logger.info("After input: " + str(len(self.originImageFilesByChannel)))
 
 
     def transformAllOriginImages(self):
         """ this function uses the transform parameter map found by `imageTransformer` 
-            to transform all origin images, i.e. to align them to destination images
+            to transform all origin images, i.e. to align them to destination images.
         """
-        self.transformixImageFilter = sitk.TransformixImageFilter() 
         self.transformParameterMap = self.imageTransformer.getTransformParameterMap()
-        self.transformParameterMap[0]['FinalBSplineInterpolationOrder'] = ['1']
-        self.transformixImageFilter.SetTransformParameterMap(self.transformParameterMap) # object transformixImageFilter is now ready to transform images with feed to it.
-        print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + "Transforming channel images started")
+        transformImage = makeImageTransform(self.transformParameterMap, batchResampling = self.batchResampling)
+        logger.info("Transforming channel images started")
         for channel in self.originImageFilesByChannel:
-            print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + "Transforming images from channel " + channel)
+            logger.info("Transforming images from channel " + channel)
             imagesPaths_input = [pathjoin(self.originImagesFolder, originSingleImage) for originSingleImage in self.originImageFilesByChannel[channel]]
-            images3D_input = sitk.ReadImage(imagesPaths_input)
-            images2D_input = sitk.Extract(images3D_input, (images3D_input.GetWidth(), images3D_input.GetHeight(), 0), (0,0,0))
-            self.transformixImageFilter.SetMovingImage(images2D_input)
-            self.transformixImageFilter.Execute()
+            resultImage = transformImage(readImage2D(imagesPaths_input))
             imagesPaths_output = pathjoin(self.resultDirectory, self.originImageFilesByChannel[channel][0])
-            sitk.WriteImage(sitk.Cast(self.transformixImageFilter.GetResultImage(),sitk.sitkUInt8),
-                            imagesPaths_output)
-        print(datetime.now().strftime("%Y-%d-%m_%H:%M:%S: ") + "Transforming channel images finished")
+            self.writeResultImage(resultImage, imagesPaths_output)
+        logger.info("Transforming channel images finished")
         
+    def writeResultImage(self, resultImage, imagePath):
+        """ writes a registered (float) image in `outputPixelType` """
+        writeResultImage(resultImage, imagePath, self.outputPixelType, self.outputCompression)
+
     def getOriginImageFiles(self):
         return self.originAllImageFiles
     
@@ -1,79 +1,150 @@
-import os, re, numpy as np, pandas as pd
-from scipy.spatial import cKDTree
-
-fov_pat = r"FOV(\d+)"
-
-def removeOverlapRolonies(rolonyDf, x_col = 'x', y_col = 'y', removeRadius = 5.5):
-    """ For each position, find those rolonies that are very close to other rolonies 
-        in other positions and remove them.
-        x_col and y_col are the names of the columns for x and y coordinates.
-        removeRadius is in any unit that x_col and y_col are.
-    """
-    geneList = rolonyDf.target.unique()
-    reducedRolonies = []
-    for gene in geneList:
-        thisGene_rolonies = rolonyDf.loc[rolonyDf.target == gene]
-        for pos in sorted(rolonyDf['fov'].unique()):
-            thisPos = thisGene_rolonies.loc[thisGene_rolonies['fov'] == pos]
-            otherPos = thisGene_rolonies.loc[thisGene_rolonies['fov'] != pos]
-            if (len(thisPos) <= 0 ) or (len(otherPos) <= 0 ):
-                continue
-            nnFinder = cKDTree(thisPos[[x_col, y_col]])
-            nearestDists, nearestInds = nnFinder.query(otherPos[[x_col, y_col]], distance_upper_bound = removeRadius)
-            toRemoveFromThisPos_index = thisPos.index[nearestInds[nearestDists < np.inf]]
-            thisGene_rolonies = thisGene_rolonies.drop(toRemoveFromThisPos_index)
-        reducedRolonies.append(thisGene_rolonies)
-    return pd.concat(reducedRolonies) 
-
-
-def filterByEmptyFraction(spot_df, cutoff):
-    spot_df = spot_df.sort_values('distance')
-    spot_df['isEmpty'] = spot_df['target'].str.startswith('Empty')
-    spot_df['cum_empty'] = spot_df['isEmpty'].cumsum()
-    spot_df['cum_empty_rate'] = spot_df['cum_empty'] / np.arange(1, spot_df.shape[0] + 1)
-    spot_df_trimmed = spot_df.loc[spot_df['cum_empty_rate'] <= cutoff]
-    return spot_df_trimmed, spot_df
-
-
-def makeSpotTable(files_paths, emptyFractionCutoff, voxel_info):
-    # Concatenating spots from all FOVs and converting the physical coordinates to pixels 
-    allspots = []
-    for file in files_paths: 
-        thisSpots = pd.read_csv(file, index_col = 0)
-        thisSpots['x'] = (round(thisSpots['xc'] / voxel_info['X'])).astype(int)
-        thisSpots['y'] = (round(thisSpots['yc'] / voxel_info['Y'])).astype(int)
-        thisSpots['z'] = (round(thisSpots['zc'] / voxel_info['Z'])).astype(int)
-        thisSpots['fov'] = re.search(fov_pat, file).group()
-        allspots.append(thisSpots)
-
-    allspots = pd.concat(allspots, ignore_index=True)
-    
-    allspots['gene'] = allspots['target'].str.extract(r"^(.+)_")
-    
-    allspots = allspots.sort_values('distance')
-
-    # Removing duplicate rolonies caused the overlapping regions of FOVs
-    allspots_reduced = removeOverlapRolonies(allspots, x_col='x', y_col = 'y', removeRadius=5.5)
-
-    # Keeping only spots with small distance to barcode so that `emptyFractionThresh` of spots are empty.
-    allspots_trimmed, allspots_reduced = filterByEmptyFraction(allspots_reduced, cutoff=emptyFractionCutoff)
-
-    return allspots_trimmed, allspots_reduced
-
-
-def combine_fovs(decoding_dir, voxel, emptyFractionThresh=0.12):
-
-    bcmags = [file for file in os.listdir(decoding_dir)
-              if os.path.isdir(os.path.join(decoding_dir, file))
-              and 'bcmag' in file]  # all the bcmags that were used for the experiment
-
-    for bcmag in bcmags:
-        print("filtering barcode magnitude: {}".format(bcmag))
-        all_files = [os.path.join(decoding_dir, bcmag, file)
-                 for file in os.listdir(os.path.join(decoding_dir, bcmag))
-                 if re.search(fov_pat, file)]
-
-        all_files.sort(key=lambda x: int(re.search(fov_pat, x).group(1)))
-        filtered_spots, _ = makeSpotTable(all_files, emptyFractionThresh, voxel)
-        filtered_spots.reset_index(drop=True).to_csv(os.path.join(decoding_dir, bcmag, 'all_spots_filtered.tsv'),
-                                                   sep='\t')
+import os, re, numpy as np, pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+
+fov_pat = r"FOV(\d+)"
+
+# the columns of the decoded spot tables that are combined; the others are not read
+spot_table_columns = ['spot_id', 'target', 'radius', 'distance', 'xc', 'yc', 'zc', 'area']
+
+def removeOverlapRolonies(rolonyDf, x_col = 'x', y_col = 'y', removeRadius = 5.5):
+    """ For each position, find those rolonies that are very close to other rolonies 
+        in other positions and remove them.
+        x_col and y_col are the names of the columns for x and y coordinates.
+        removeRadius is in any unit that x_col and y_col are.
+    """
+    geneList = rolonyDf.target.unique()
+    reducedRolonies = []
+    for gene in geneList:
+        thisGene_rolonies = rolonyDf.loc[rolonyDf.target == gene]
+        for pos in sorted(rolonyDf['fov'].unique()):
+            thisPos = thisGene_rolonies.loc[thisGene_rolonies['fov'] == pos]
+            otherPos = thisGene_rolonies.loc[thisGene_rolonies['fov'] != pos]
+            if (len(thisPos) <= 0 ) or (len(otherPos) <= 0 ):
+                continue
+            nnFinder = cKDTree(thisPos[[x_col, y_col]])
+            nearestDists, nearestInds = nnFinder.query(otherPos[[x_col, y_col]], distance_upper_bound = removeRadius)
+            toRemoveFromThisPos_index = thisPos.index[nearestInds[nearestDists < np.inf]]
+            thisGene_rolonies = thisGene_rolonies.drop(toRemoveFromThisPos_index)
+        reducedRolonies.append(thisGene_rolonies)
+    return pd.concat(reducedRolonies) 
+
+
+def overlapBandMask(rolonyDf, x_col='x', y_col='y', margin=5.5):
+    """ True for the rolonies within `margin` of the bounding box of the rolonies of another position,
+        i.e. in the overlap bands of the stitched positions: only those can be close to a rolony of
+        another position.
+    """
+    x, y, fovs = rolonyDf[x_col].values, rolonyDf[y_col].values, rolonyDf['fov'].values
+    bounds = rolonyDf.groupby('fov').agg(x_min=(x_col, 'min'), x_max=(x_col, 'max'),
+                                         y_min=(y_col, 'min'), y_max=(y_col, 'max'))
+    order = np.argsort(x, kind='stable')
+    sorted_x = x[order]
+    inBand = np.zeros(len(rolonyDf), dtype=bool)
+    for pos, x_min, x_max, y_min, y_max in bounds.itertuples():
+        # rolonies of the x range of the position's box, then of its y range
+        start = np.searchsorted(sorted_x, x_min - margin, side='left')
+        stop = np.searchsorted(sorted_x, x_max + margin, side='right')
+        candidates = order[start:stop]
+        candidates = candidates[(y[candidates] >= y_min - margin) & (y[candidates] <= y_max + margin) &
+                                (fovs[candidates] != pos)]
+        inBand[candidates] = True
+    return inBand
+
+
+def removeOverlapRoloniesKDTree(rolonyDf, x_col='x', y_col='y', removeRadius=5.5):
+    """ Same purpose as `removeOverlapRolonies` in one pass over all genes and positions: a single
+        KD-tree over the rolonies of the overlap bands (`overlapBandMask`), with the genes set far apart
+        along a third axis, finds every pair of rolonies of one gene in two positions closer than
+        removeRadius, and the rolony of the position that sorts first is removed.
+        Unlike the loop, a rolony close to several rolonies of another position is removed even if it is
+        not the nearest one of any of them.
+    """
+    band = rolonyDf.loc[overlapBandMask(rolonyDf, x_col, y_col, margin=removeRadius)]
+    gene_code = pd.factorize(band['target'])[0]
+    fov_rank = pd.Categorical(band['fov'], categories=sorted(rolonyDf['fov'].unique())).codes
+    points = np.column_stack([band[x_col].values, band[y_col].values, gene_code * 4.0 * removeRadius])
+
+    # strictly closer than removeRadius, as the distance_upper_bound of the loop
+    pairs = cKDTree(points).query_pairs(r=np.nextafter(removeRadius, 0), output_type='ndarray')
+    first, second = pairs[:, 0], pairs[:, 1]
+    across = fov_rank[first] != fov_rank[second]
+    toRemove = np.where(fov_rank[first] < fov_rank[second], first, second)[across]
+    return rolonyDf.drop(band.index[np.unique(toRemove)])
+
+
+def filterByEmptyFraction(spot_df, cutoff):
+    spot_df = spot_df.sort_values('distance')
+    spot_df['isEmpty'] = spot_df['target'].str.startswith('Empty')
+    spot_df['cum_empty'] = spot_df['isEmpty'].cumsum()
+    spot_df['cum_empty_rate'] = spot_df['cum_empty'] / np.arange(1, spot_df.shape[0] + 1)
+    spot_df_trimmed = spot_df.loc[spot_df['cum_empty_rate'] <= cutoff]
+    return spot_df_trimmed, spot_df
+
+
+def read_spot_table(file_path, columns=None):
+    """ reads only `columns` (all if None) of a decoded spot table, Parquet or CSV """
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path, columns=columns)
+    if columns is None:
+        return pd.read_csv(file_path, index_col=0)
+    return pd.read_csv(file_path, usecols=columns)
+
+
+def makeSpotTable(files_paths, emptyFractionCutoff, voxel_info, columns=spot_table_columns, workers=1,
+                  dedup_engine='loop'):
+    """ workers: number of threads reading the FOV tables concurrently (the parsers release the GIL)
+        dedup_engine: 'loop' (`removeOverlapRolonies`) or 'kdtree' (`removeOverlapRoloniesKDTree`)
+    """
+    # Concatenating spots from all FOVs and converting the physical coordinates to pixels 
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            fov_spots = list(executor.map(lambda file: read_spot_table(file, columns), files_paths))
+    else:
+        fov_spots = [read_spot_table(file, columns) for file in files_paths]
+
+    allspots = pd.concat(fov_spots, ignore_index=True)
+    # converted and tagged once for all FOVs; rint rounds half to even, as Series.round
+    for axis in ['x', 'y', 'z']:
+        allspots[axis] = np.rint(allspots[axis + 'c'].values / voxel_info[axis.upper()]).astype(int)
+    allspots['fov'] = np.repeat([re.search(fov_pat, file).group() for file in files_paths],
+                                [len(spots) for spots in fov_spots])
+    
+    allspots['gene'] = allspots['target'].str.extract(r"^(.+)_")
+    
+    allspots = allspots.sort_values('distance')
+
+    # Removing duplicate rolonies caused the overlapping regions of FOVs
+    if dedup_engine == 'kdtree':
+        allspots_reduced = removeOverlapRoloniesKDTree(allspots, x_col='x', y_col='y', removeRadius=5.5)
+    else:
+        allspots_reduced = removeOverlapRolonies(allspots, x_col='x', y_col = 'y', removeRadius=5.5)
+
+    # Keeping only spots with small distance to barcode so that `emptyFractionThresh` of spots are empty.
+    allspots_trimmed, allspots_reduced = filterByEmptyFraction(allspots_reduced, cutoff=emptyFractionCutoff)
+
+    return allspots_trimmed, allspots_reduced
+
+
+def combine_fovs(decoding_dir, voxel, emptyFractionThresh=0.12, table_format='csv', workers=1,
+                 dedup_engine='loop'):
+    """ table_format: 'csv' or 'parquet', format of the decoded spot tables to combine
+        workers: number of threads reading the tables
+        dedup_engine: how the rolonies of overlapping FOVs are deduplicated, see `makeSpotTable`
+    """
+
+    bcmags = [file for file in os.listdir(decoding_dir)
+              if os.path.isdir(os.path.join(decoding_dir, file))
+              and 'bcmag' in file]  # all the bcmags that were used for the experiment
+
+    for bcmag in bcmags:
+        print("filtering barcode magnitude: {}".format(bcmag))
+        all_files = [os.path.join(decoding_dir, bcmag, file)
+                 for file in os.listdir(os.path.join(decoding_dir, bcmag))
+                 if re.search(fov_pat, file) and file.endswith('.' + table_format)]
+
+        all_files.sort(key=lambda x: int(re.search(fov_pat, x).group(1)))
+        filtered_spots, _ = makeSpotTable(all_files, emptyFractionThresh, voxel, workers=workers,
+                                          dedup_engine=dedup_engine)
+        filtered_spots.reset_index(drop=True).to_csv(os.path.join(decoding_dir, bcmag, 'all_spots_filtered.tsv'),
+                                                   sep='\t')
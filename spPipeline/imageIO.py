@@ -0,0 +1,51 @@
+import os
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from spPipeline.code_lib import tifffile as tiff
+
+
+def read_plane(file_path, memmap=True):
+    """ Reads a single-plane TIFF with the vendored tifffile, keeping its native dtype (e.g. uint16).
+        Uncompressed, contiguous pages are memory-mapped so that only the pages the caller touches
+        are read; compressed pages fall back to a full decode.
+    """
+    with tiff.TiffFile(file_path) as tif:
+        page = tif.pages[0]
+        return page.asarray(memmap=memmap and not page.compression)
+
+
+def write_image(file_path, array, compress=0):
+    """ Writes a 2D array as TIFF with the vendored tifffile, keeping its dtype (e.g. uint16 or float32).
+        compress: zlib level 0-9 (0: uncompressed) or 'lzma'
+    """
+    tiff.imsave(file_path, array, compress=compress)
+
+
+def benchmark_plane_readers(file_paths, n_repeat=3, readers=None):
+    """ Micro-benchmark of plane readers on `file_paths`.
+        readers: dict of name -> function(path) returning an array; defaults to the vendored tifffile
+        reader (memory-mapped and full read) and matplotlib's imread used before.
+        Every plane is reduced with .max() so that memory-mapped pages are actually read.
+        Returns a DataFrame with the mean seconds per plane and the dtype each reader returns.
+    """
+    if readers is None:
+        import matplotlib.pyplot as plt
+        readers = {'tifffile_memmap': read_plane,
+                   'tifffile_read': lambda file_path: read_plane(file_path, memmap=False),
+                   'plt.imread': plt.imread}
+
+    rows = []
+    for name, reader in readers.items():
+        timings = []
+        for _ in range(n_repeat):
+            start = perf_counter()
+            for file_path in file_paths:
+                reader(file_path).max()
+            timings.append((perf_counter() - start) / len(file_paths))
+        rows.append({'reader': name,
+                     'sec_per_plane': np.mean(timings),
+                     'sec_per_plane_min': np.min(timings),
+                     'dtype': str(reader(file_paths[0]).dtype),
+                     'MB_per_plane': os.path.getsize(file_paths[0]) / 2 ** 20})
+    return pd.DataFrame(rows).sort_values('sec_per_plane').reset_index(drop=True)
@@ -0,0 +1,135 @@
+import os, json, hashlib
+from datetime import datetime
+
+# file name of the manifest, written in the output directory: one JSON line per recorded unit
+manifest_file = "_run_manifest.jsonl"
+
+
+def list_files(paths):
+    """ the files of `paths`, with directories expanded recursively, sorted """
+    files = []
+    for file_path in paths:
+        if os.path.isdir(file_path):
+            for root, _, names in os.walk(file_path):
+                files.extend(os.path.join(root, name) for name in names)
+        elif os.path.isfile(file_path):
+            files.append(file_path)
+    return sorted(files)
+
+
+def file_sha1(file_path):
+    """ {'size', 'mtime', 'sha1'} of a file, the form in which the manifest caches file hashes """
+    stat = os.stat(file_path)
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 22), b''):
+            sha1.update(chunk)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': sha1.hexdigest()}
+
+
+def hash_outputs(paths):
+    """ {file: file_sha1(file)} of the files of `paths` (directories expanded) """
+    return {file_path: file_sha1(file_path) for file_path in list_files(paths)}
+
+
+def run_and_hash(func, outputs, *args, **kwargs):
+    """ Runs func(*args, **kwargs) and hashes its `outputs` in the same process, i.e. in the pool
+        worker that produced them rather than in the main process. Returns (result, output hashes).
+    """
+    result = func(*args, **kwargs)
+    return result, hash_outputs(outputs)
+
+
+class RunManifest:
+    """ Checkpoints of a pipeline run, kept as JSON lines in the output directory.
+        Every unit of work (a stage, or a stage of one FOV) is recorded with its parameters, the content
+        hashes of its input and output files and the size and modification time of its raw inputs
+        once it finished. A unit whose parameters are the same, whose inputs are unchanged and whose
+        outputs are all still there unchanged is complete and can be skipped on `--resume`; anything
+        else reruns, and so do the units downstream of it, as their inputs change.
+        Output hashes are computed by the task that wrote the files (see `run_and_hash`) and cached by
+        size and modification time, so the inputs of downstream units are not hashed again.
+        Each record is appended as one line; the file is compacted to one line per unit when it is
+        opened. Only the main process reads and writes the manifest.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, manifest_file)
+        self.units = {}
+        self.hashes = {}
+        if os.path.isfile(self.path):
+            n_lines = 0
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a killed run
+                        continue
+                    n_lines += 1
+                    self.units[record['unit']] = record['entry']
+                    self.hashes.update(record['hashes'])
+            if n_lines > len(self.units):
+                self.compact()
+
+    def file_hash(self, file_path):
+        stat = os.stat(file_path)
+        key = os.path.abspath(file_path)
+        cached = self.hashes.get(key)
+        if cached is None or cached['size'] != stat.st_size or cached['mtime'] != stat.st_mtime_ns:
+            cached = self.hashes[key] = file_sha1(file_path)
+        return cached['sha1']
+
+    def hash_files(self, paths):
+        """ {file: sha1} of the files of `paths` (directories expanded) """
+        return {file_path: self.file_hash(file_path) for file_path in list_files(paths)}
+
+    @staticmethod
+    def stat_files(paths):
+        """ {file: [size, mtime in ns]} of the files of `paths`, for raw inputs too large to hash """
+        stats = {}
+        for file_path in list_files(paths):
+            stat = os.stat(file_path)
+            stats[file_path] = [stat.st_size, stat.st_mtime_ns]
+        return stats
+
+    def is_complete(self, unit, inputs, params, raw_inputs=()):
+        """ True if `unit` finished before with the same parameters, inputs and outputs """
+        entry = self.units.get(unit)
+        if entry is None or entry['params'] != json.loads(json.dumps(params)):
+            return False
+        if self.stat_files(raw_inputs) != entry['raw_inputs'] or self.hash_files(inputs) != entry['inputs']:
+            return False
+        for file_path, sha1 in entry['outputs'].items():
+            if not os.path.isfile(file_path) or self.file_hash(file_path) != sha1:
+                return False
+        return True
+
+    def record(self, unit, inputs, params, output_hashes, raw_inputs=()):
+        """ Records `unit` as complete. `inputs` and `raw_inputs` are files or directories;
+            `output_hashes` are the hashes of its outputs from `run_and_hash`.
+        """
+        hashes = {os.path.abspath(file_path): cached for file_path, cached in output_hashes.items()}
+        self.hashes.update(hashes)
+        self.units[unit] = {'params': json.loads(json.dumps(params)),
+                            'raw_inputs': self.stat_files(raw_inputs),
+                            'inputs': self.hash_files(inputs),
+                            'outputs': {file_path: cached['sha1'] for file_path, cached in output_hashes.items()},
+                            'finished': datetime.now().strftime("%Y-%m-%d_%H:%M:%S")}
+        # one append of a whole line, so that a run killed mid-write loses at most this record
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps({'unit': unit, 'entry': self.units[unit], 'hashes': hashes}) + '\n').encode())
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """ rewrites the manifest with only the latest record of every unit """
+        # written to a temporary file first so that a run killed mid-write keeps the previous manifest
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for unit, entry in self.units.items():
+                hashes = {os.path.abspath(file_path): self.hashes[os.path.abspath(file_path)]
+                          for file_path in entry['outputs'] if os.path.abspath(file_path) in self.hashes}
+                f.write(json.dumps({'unit': unit, 'entry': entry, 'hashes': hashes}) + '\n')
+        os.replace(temp_path, self.path)
@@ -0,0 +1,150 @@
+import os, json, resource, threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import time
+import pandas as pd
+
+# the metrics file and run id go through the environment so that pool workers, forked or spawned,
+# write to the same file as the main process
+metrics_env = "SPPIPELINE_METRICS"
+run_env = "SPPIPELINE_RUN"
+
+
+def set_metrics_file(file_path):
+    """ sends the metrics of this process and of the processes it starts to `file_path` (JSON lines) """
+    os.environ[metrics_env] = file_path
+    # the start time orders the runs; the pid tells apart runs started in the same second
+    os.environ[run_env] = "{0}_{1}".format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"), os.getpid())
+
+
+# /proc/self/io counters and the metrics columns (MB) they are reported in: rchar/wchar count the
+# bytes of read/write calls, page-cache hits included, but miss memory-mapped reads; read_bytes/
+# write_bytes count what the process made the storage read or write, memory-mapped reads included
+io_counters = {'rchar': 'read_MB', 'wchar': 'written_MB', 'read_bytes': 'disk_read_MB',
+               'write_bytes': 'disk_written_MB'}
+
+
+def io_bytes():
+    """ {counter: bytes} of the `io_counters` of this process so far, from /proc/self/io (None where unavailable) """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return {counter: int(counters[counter]) for counter in io_counters}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# peak RSS (MB) seen so far by each `measure` block still open in this process, by block
+_open_peaks = {}
+_peaks_lock = threading.Lock()
+
+
+def rss_peak():
+    """ peak RSS of this process in MB since the last `reset_rss_peak` (VmHWM of /proc/self/status),
+        or over its lifetime from getrusage where /proc is unavailable
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_rss_peak():
+    """ resets the peak RSS of this process to its current RSS (no-op where /proc is unavailable) """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _fold_peak():
+    """ records the current peak RSS in every open block; call with _peaks_lock held """
+    peak = rss_peak()
+    for block in _open_peaks:
+        _open_peaks[block] = max(_open_peaks[block], peak)
+
+
+def cpu_seconds():
+    """ user + system CPU time of this process and of its finished child processes (pool workers, ImageJ) """
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+@contextmanager
+def measure(stage, fov=None, **tags):
+    """ Measures the enclosed block and appends one JSON line to the metrics file: wall and CPU
+        seconds, peak RSS of the process during the block (MB, peak_rss_MB) and MB read and
+        written (see `io_counters`). Rows of one FOV carry its number; other `tags` (e.g. rnd, channel) are kept as is.
+        Does nothing unless `set_metrics_file` was called.
+    """
+    metrics_file = os.environ.get(metrics_env)
+    if metrics_file is None:
+        yield
+        return
+
+    # the peak is reset at the start of the block; blocks open in the same process (enclosing ones,
+    # or other threads) get the peaks recorded before each reset, so none of them loses its own
+    block = object()
+    with _peaks_lock:
+        _fold_peak()
+        reset_rss_peak()
+        _open_peaks[block] = 0.0
+    start_wall, start_cpu = time(), cpu_seconds()
+    start_io = io_bytes()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        end_io = io_bytes()
+        with _peaks_lock:
+            _fold_peak()
+            peak_rss = _open_peaks.pop(block)
+        row = dict({'run': os.environ.get(run_env), 'stage': stage, 'fov': fov,
+                    'wall_s': time() - start_wall, 'cpu_s': cpu_seconds() - start_cpu,
+                    'peak_rss_MB': peak_rss,
+                    'pid': os.getpid(), 'failed': failed}, **tags)
+        for counter, column in io_counters.items():
+            row[column] = None if start_io is None else (end_io[counter] - start_io[counter]) / 2 ** 20
+        # one append of a whole line, so that lines of concurrent workers do not interleave
+        fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(row) + '\n').encode())
+        finally:
+            os.close(fd)
+
+
+def summarize(metrics_file, run=None):
+    """ Per-stage summary of the metrics of one run (by default the last one) as a DataFrame.
+        Stage-level rows and per-FOV rows are summarized separately (`level`).
+    """
+    rows = pd.read_json(metrics_file, lines=True)
+    if run is None:
+        run = rows.run.iloc[-1]
+    rows = rows[rows.run == run].copy()
+    rows['level'] = rows.fov.isna().map({True: 'stage', False: 'fov'})
+    summary = rows.groupby(['stage', 'level'], sort=False).agg(
+        n=('wall_s', 'size'), wall_s=('wall_s', 'sum'), wall_s_max=('wall_s', 'max'),
+        cpu_s=('cpu_s', 'sum'), peak_rss_MB=('peak_rss_MB', 'max'),
+        **{column: (column, 'sum') for column in io_counters.values()})
+    return summary.reset_index()
+
+
+def print_summary(metrics_file=None):
+    """ prints the per-stage summary of the current run """
+    metrics_file = metrics_file or os.environ.get(metrics_env)
+    if metrics_file is None or not os.path.isfile(metrics_file):
+        return
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(summarize(metrics_file, run=os.environ.get(run_env)).round(2).to_string(index=False))
+    print("peak_rss_MB: peak RSS of the process during the stage (VmHWM, reset at the start of each measure)")
+    print("read_MB/written_MB: read/write calls (/proc/self/io rchar/wchar, page-cache hits included, "
+          "memory-mapped reads missed); disk_read_MB/disk_written_MB: storage I/O (read_bytes/write_bytes)")
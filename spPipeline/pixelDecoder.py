@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+from scipy.ndimage import find_objects
+from skimage.measure import label
+
+# columns of the spot tables written by starfish (IntensityTable.to_features_dataframe) plus 'area'
+spot_columns = ['z', 'y', 'x', 'target', 'radius', 'spot_id', 'distance', 'passes_thresholds', 'features',
+                'xc', 'yc', 'zc', 'area']
+
+
+def normalized_codes(codes, dtype=np.float32):
+    """ codes: (targets, rounds, channels) -> unit-length code vectors, (targets, rounds * channels) """
+    linear_codes = np.asarray(codes, dtype=dtype).reshape(len(codes), -1)
+    return linear_codes / np.linalg.norm(linear_codes, axis=1, keepdims=True)
+
+
+def decode_pixels(data, codes, batch_size=2 ** 16, dtype=np.float32):
+    """ Nearest codeword of every pixel, as Codebook.decode_metric with the euclidean metric.
+        data: (rounds, channels, z, y, x) filtered images; codes: (targets, rounds, channels)
+        Every pixel trace is L2-normalized and matched to the code with the largest dot product,
+        i.e. the smallest euclidean distance sqrt(2 - 2 cos) between unit vectors, in batches of
+        `batch_size` pixels so that the (targets x pixels) similarity matrix stays small.
+        dtype: precision of the whole computation; float32 halves the memory traffic of float64
+        (see `compare_spots` to validate it against float64 on a FOV)
+        Returns the target index, the distance and the trace magnitude of every pixel, each (z, y, x).
+    """
+    n_traces = data.shape[0] * data.shape[1]
+    pixels = np.asarray(data, dtype=dtype).reshape(n_traces, -1)
+    unit_codes = normalized_codes(codes, dtype)
+    n_pixels = pixels.shape[1]
+
+    magnitudes = np.sqrt(np.einsum('fp,fp->p', pixels, pixels))
+    target_index = np.empty(n_pixels, dtype=np.int32)
+    distances = np.empty(n_pixels, dtype=dtype)
+    for start in range(0, n_pixels, batch_size):
+        stop = min(start + batch_size, n_pixels)
+        batch_magnitudes = magnitudes[start:stop]
+        # all-zero traces have no direction; they are left at distance sqrt(2) from every code
+        unit_pixels = pixels[:, start:stop] / np.where(batch_magnitudes > 0, batch_magnitudes, np.inf)
+        similarity = unit_codes @ unit_pixels
+        best = similarity.argmax(axis=0)
+        target_index[start:stop] = best
+        distances[start:stop] = np.sqrt(np.maximum(2 - 2 * similarity[best, np.arange(stop - start)], 0))
+
+    shape = data.shape[2:]
+    return target_index.reshape(shape), distances.reshape(shape), magnitudes.reshape(shape)
+
+
+def physical_coordinates(pixel_offsets, coordinates):
+    """ physical coordinates of (fractional) pixel offsets, interpolated as starfish does """
+    if len(coordinates) == 1:
+        return np.full(len(pixel_offsets), coordinates[0], dtype=float)
+    return np.interp(pixel_offsets, np.arange(len(coordinates)), coordinates)
+
+
+def tile_grid(image_shape, tile_size, overlap):
+    """ Overlapping tiles covering a (height, width) image, as (core, extended) pairs of
+        (y_start, y_stop, x_start, x_stop): the cores partition the image in tile_size x tile_size
+        squares and every extended tile is its core grown by `overlap` pixels, within the image.
+    """
+    height, width = image_shape
+    tiles = []
+    for y_start in range(0, height, tile_size):
+        for x_start in range(0, width, tile_size):
+            core = (y_start, min(y_start + tile_size, height), x_start, min(x_start + tile_size, width))
+            extended = (max(core[0] - overlap, 0), min(core[1] + overlap, height),
+                        max(core[2] - overlap, 0), min(core[3] + overlap, width))
+            tiles.append((core, extended))
+    return tiles
+
+
+def call_spots(target_index, distances, magnitudes, targets, magnitude_threshold, distance_threshold,
+               area_threshold=(5, 100), physical_coords=None, connectivity=2, tile=None, image_shape=None):
+    """ Spots from decoded pixels, as CombineAdjacentFeatures after PixelSpotDecoder: the pixels passing
+        both thresholds are labeled into connected components of the same target, and components with
+        min_area <= area < max_area are kept.
+        targets: target names by target index; physical_coords: {'z', 'y', 'x': physical coordinate of
+        every pixel along that axis}, used for the xc, yc, zc columns.
+        tile: (core, extended) of `tile_grid` if the pixels are the extended tile of an image of
+        `image_shape`. Only the spots whose centroid falls in the core are kept, in image pixel
+        coordinates, and components cut by the edge of the extended tile are dropped: with an
+        overlap of at least max_area pixels, every spot is then called whole in exactly one tile.
+        Returns a DataFrame with the columns of the starfish spot tables (`spot_columns`).
+    """
+    passes = np.logical_and(magnitudes >= magnitude_threshold, distances <= distance_threshold)
+    decoded_image = np.where(passes, target_index + 1, 0)
+    label_image = label(decoded_image, connectivity=connectivity).ravel()
+
+    # per-component sums over the pixels with one bincount each; component 0 is the background
+    n_labels = label_image.max() + 1
+    area = np.bincount(label_image, minlength=n_labels)[1:]
+    z, y, x = np.indices(decoded_image.shape).reshape(3, -1)
+    centroids = {axis: np.bincount(label_image, weights=coord, minlength=n_labels)[1:] / area
+                 for axis, coord in (('z', z), ('y', y), ('x', x))}
+    mean_distance = np.bincount(label_image, weights=distances.ravel(), minlength=n_labels)[1:] / area
+    # every pixel of a component decodes to the same target
+    component_target = np.zeros(n_labels, dtype=np.int64)
+    component_target[label_image] = decoded_image.ravel() - 1
+
+    spots = pd.DataFrame({'z': centroids['z'].astype(int), 'y': centroids['y'].astype(int),
+                          'x': centroids['x'].astype(int),
+                          'target': np.asarray(targets)[component_target[1:]],
+                          'radius': np.sqrt(area / np.pi),
+                          'spot_id': np.arange(n_labels - 1),
+                          'distance': mean_distance,
+                          'passes_thresholds': (area >= area_threshold[0]) & (area < area_threshold[1]),
+                          'features': np.arange(n_labels - 1)})
+    for axis in 'zyx':
+        coordinates = np.arange(decoded_image.shape['zyx'.index(axis)]) if physical_coords is None \
+            else physical_coords[axis]
+        spots[axis + 'c'] = physical_coordinates(spots[axis].values, coordinates)
+    spots['area'] = np.pi * spots.radius ** 2
+
+    keep = spots.passes_thresholds
+    if tile is not None:
+        core, extended = tile
+        spots['y'] += extended[0]
+        spots['x'] += extended[2]
+        keep &= spots.y.between(core[0], core[1] - 1) & spots.x.between(core[2], core[3] - 1)
+        # bounding boxes of the components, to find those cut by an edge of the tile inside the image
+        boxes = find_objects(label_image.reshape(decoded_image.shape))
+        y_start, y_stop, x_start, x_stop = (np.array([box[axis].start if start else box[axis].stop
+                                                      for box in boxes], dtype=int)
+                                            for axis, start in ((1, True), (1, False), (2, True), (2, False)))
+        height, width = decoded_image.shape[1:]
+        cut = ((y_start == 0) & (extended[0] > 0)) | ((y_stop == height) & (extended[1] < image_shape[0])) | \
+              ((x_start == 0) & (extended[2] > 0)) | ((x_stop == width) & (extended[3] < image_shape[1]))
+        keep &= ~cut
+
+    return spots.loc[keep, spot_columns].reset_index(drop=True)
+
+
+def compare_spots(reference, spots):
+    """ Agreement of two spot tables of one FOV, e.g. decoded in float64 and in float32: spots are
+        matched on their pixel position and target. Returns the spot counts, the matched and unmatched
+        ones and the largest difference of the distance and area of the matched spots.
+    """
+    keys = ['z', 'y', 'x', 'target']
+    matched = reference.merge(spots, on=keys, suffixes=('_reference', ''))
+    return {'n_reference': len(reference), 'n_spots': len(spots), 'n_matched': len(matched),
+            'n_reference_only': len(reference) - len(matched), 'n_spots_only': len(spots) - len(matched),
+            'max_distance_difference': float((matched.distance - matched.distance_reference).abs().max())
+            if len(matched) else 0.0,
+            'max_area_difference': float((matched.area - matched.area_reference).abs().max()) if len(matched) else 0.0}
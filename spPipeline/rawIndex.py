@@ -0,0 +1,85 @@
+import os, re
+from functools import lru_cache
+import pandas as pd
+
+# file name of the cached index, written in each round directory
+index_file = "_raw_index.csv"
+
+fov_pat = r"_s(\d+)"
+z_pat = r"_z(\d+)"
+ch_pat = r"_(ch\d+)\.tif"
+
+
+def parse_raw_name(file_name):
+    """ Returns (fov, z, channel) of a raw z-plane file name (e.g. 'Position_s01_z05_ch00.tif'),
+        or None if the name is not a raw plane. z is -1 if the name has no z tag.
+    """
+    fovs = re.findall(fov_pat, file_name)
+    ch = re.search(ch_pat, file_name)
+    if not fovs or ch is None:
+        return None
+    z = re.search(z_pat, file_name)
+    return int(fovs[-1]), int(z.group(1)) if z is not None else -1, ch.group(1)
+
+
+class RawFileIndex:
+    """ Index of the raw z-plane files of one round directory.
+        The directory is scanned once and every file name is parsed into its FOV, z and channel,
+        so that finding the planes of one (FOV, channel) is a dictionary lookup instead of a regex
+        over the whole directory. The table is cached as `_raw_index.csv` in the round directory
+        and reused as long as the directory has not changed since.
+    """
+    def __init__(self, rnd_dir, use_cache=True):
+        self.rnd_dir = rnd_dir
+        self.cache_path = os.path.join(rnd_dir, index_file)
+
+        table = self.read_cache() if use_cache else None
+        if table is None:
+            table = self.scan()
+            if use_cache:
+                self.write_cache(table)
+        self.table = table
+
+        # (fov, channel) -> file names sorted by z
+        self.files = {key: list(group.sort_values('z')['file'])
+                      for key, group in table.groupby(['fov', 'channel'])}
+
+    def scan(self):
+        rows = []
+        for file_name in os.listdir(self.rnd_dir):
+            parsed = parse_raw_name(file_name)
+            if parsed is not None:
+                rows.append((file_name,) + parsed)
+        return pd.DataFrame(rows, columns=['file', 'fov', 'z', 'channel'])
+
+    def read_cache(self):
+        """ the cached table, or None if it is missing or older than the directory """
+        if not os.path.isfile(self.cache_path):
+            return None
+        if os.stat(self.cache_path).st_mtime_ns < os.stat(self.rnd_dir).st_mtime_ns:
+            return None
+        return pd.read_csv(self.cache_path, dtype={'file': str, 'fov': int, 'z': int, 'channel': str})
+
+    def write_cache(self, table):
+        # written to a temporary file of this process first, so that other processes (pool workers,
+        # another run) never read a half-written cache
+        temp_path = "{0}.{1}.tmp".format(self.cache_path, os.getpid())
+        try:
+            table.to_csv(temp_path, index=False)
+            os.replace(temp_path, self.cache_path)
+            # the rename changes the directory's mtime: touch the cache so that it is not older
+            os.utime(self.cache_path)
+        except OSError:
+            # raw data may live on a read-only share; the index still works without the cache
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    def lookup(self, fov, channel):
+        """ names of the z-plane files of `fov` and `channel` (e.g. 'ch00'), sorted by z """
+        return self.files.get((fov, channel), [])
+
+
+@lru_cache(maxsize=None)
+def get_raw_index(rnd_dir):
+    """ RawFileIndex of `rnd_dir`, built once per process """
+    return RawFileIndex(rnd_dir)
@@ -0,0 +1,111 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class Task:
+    """ one unit of work of the pipeline: func(*args, **kwargs), run once every task in `deps` finished """
+
+    def __init__(self, name, func, args=(), kwargs=None, deps=(), order=0, skip=None, on_done=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = list(deps)
+        # tasks added earlier are started first among the ready ones
+        self.order = order
+        # called in the main process once the task is ready: True skips it (e.g. already complete)
+        self.skip = skip
+        # called in the main process with the task's result once it finished (e.g. to checkpoint it)
+        self.on_done = on_done
+
+
+class TaskGraph:
+    """ Dependency-aware scheduler of the pipeline stages.
+        Every task is given to a pool of `workers` processes as soon as all its dependencies finished,
+        so the per-FOV stages of different FOVs overlap and only the truly global stages (stitching,
+        combining the FOVs) wait for every FOV. Among the ready tasks, the one added first is started
+        first: adding the stages of each FOV one after the other moves FOVs through the pipeline
+        depth-first instead of finishing one stage for all FOVs before starting the next.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        # results of the finished tasks, by name
+        self.results = {}
+
+    def add(self, name, func, *args, deps=(), skip=None, on_done=None, **kwargs):
+        """ adds a task and returns its name, to be used in the `deps` of later tasks """
+        if name in self.tasks:
+            raise ValueError("Task {0} already exists".format(name))
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError("Task {0} depends on unknown task {1}".format(name, dep))
+        self.tasks[name] = Task(name, func, args, kwargs, deps, order=len(self.tasks), skip=skip, on_done=on_done)
+        return name
+
+    def run(self, workers=1):
+        """ Runs every task and returns {name: result}. The first failing task cancels the
+            tasks that have not started yet and its exception is raised.
+        """
+        waiting = {name: set(task.deps) for name, task in self.tasks.items()}
+        dependents = {name: [] for name in self.tasks}
+        for name, task in self.tasks.items():
+            for dep in task.deps:
+                dependents[dep].append(name)
+
+        running = {}
+        # tasks whose `skip` was already asked
+        checked = set()
+        start = time()
+
+        def finish(name):
+            for dependent in dependents[name]:
+                waiting[dependent].discard(name)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while waiting or running:
+                ready = sorted((self.tasks[name] for name, deps in waiting.items() if not deps),
+                               key=lambda task: task.order)
+                skipped = []
+                for task in ready:
+                    if task.skip is not None and task.name not in checked:
+                        checked.add(task.name)
+                        if task.skip():
+                            skipped.append(task)
+                for task in skipped:
+                    logger.info(task.name + " already complete, skipped")
+                    del waiting[task.name]
+                    finish(task.name)
+                if skipped:
+                    # their dependents may be ready (or skippable) now
+                    continue
+                for task in ready:
+                    # keep at most `workers` tasks in the process pool so that later-ready tasks of
+                    # earlier FOVs are not queued behind every task that became ready before them
+                    if len(running) >= workers:
+                        break
+                    running[pool.submit(task.func, *task.args, **task.kwargs)] = task.name
+                    del waiting[task.name]
+
+                if not running:
+                    raise RuntimeError("Tasks {0} can never start".format(sorted(waiting)))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        if self.tasks[name].on_done is not None:
+                            self.tasks[name].on_done(self.results[name])
+                    except Exception:
+                        for other in running:
+                            other.cancel()
+                        logger.error(name + " failed")
+                        raise
+                    logger.info(name + " done ({0}/{1}, {2:.1f}s)".format(len(self.results), len(self.tasks),
+                                                                          time() - start))
+                    finish(name)
+        return self.results
@@ -0,0 +1,85 @@
+import os, sys, logging, threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# every module logs to logging.getLogger(__name__), i.e. below this logger
+root_name = "spPipeline"
+log_format = "%(asctime)s %(processName)s/%(threadName)s %(name)s: %(message)s"
+date_format = "%Y-%m-%d_%H:%M:%S"
+
+# (pid, thread id) -> number of stage logs the thread is currently writing to; kept off the console
+_stage_threads = {}
+
+
+def _worker_key():
+    return os.getpid(), threading.get_ident()
+
+
+class WorkerFilter(logging.Filter):
+    """ passes only the records of one thread of one process """
+
+    def __init__(self, key):
+        super().__init__()
+        self.key = key
+
+    def filter(self, record):
+        return (record.process, record.thread) == self.key
+
+
+class ConsoleFilter(logging.Filter):
+    """ drops the records of threads that write to a stage log """
+
+    def filter(self, record):
+        return (record.process, record.thread) not in _stage_threads
+
+
+def setup_console(level=logging.INFO):
+    """ prints the records of the threads that are not in a stage log on stdout """
+    logger = logging.getLogger(root_name)
+    logger.setLevel(level)
+    if not any(isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler)
+               for handler in logger.handlers):
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(log_format, date_format))
+        handler.addFilter(ConsoleFilter())
+        logger.addHandler(handler)
+
+
+def add_stage_handler(stage, log_dir, worker=None, max_bytes=50 * 2 ** 20, backup_count=5):
+    """ Sends what the calling thread logs from now on to the rotating file
+        log_dir/[<worker>_]<stage>.log, until `remove_stage_handler`.
+        The handler only takes the records of the calling thread of the calling process, so that
+        stages running at the same time in other threads or pool workers keep their own files;
+        concurrent workers of one stage must use different `worker` names.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    file_name = "{0}.log".format(stage) if worker is None else "{0}_{1}.log".format(worker, stage)
+    handler = RotatingFileHandler(os.path.join(log_dir, file_name), maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter(log_format, date_format))
+    handler.addFilter(WorkerFilter(_worker_key()))
+
+    logger = logging.getLogger(root_name)
+    if logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    _stage_threads[_worker_key()] = _stage_threads.get(_worker_key(), 0) + 1
+    return handler
+
+
+def remove_stage_handler(handler):
+    logging.getLogger(root_name).removeHandler(handler)
+    handler.close()
+    key = _worker_key()
+    _stage_threads[key] -= 1
+    if not _stage_threads[key]:
+        del _stage_threads[key]
+
+
+@contextmanager
+def stage_log(stage, log_dir, worker=None):
+    """ `add_stage_handler` for the enclosed block """
+    handler = add_stage_handler(stage, log_dir, worker)
+    try:
+        yield handler
+    finally:
+        remove_stage_handler(handler)
@@ -1,95 +1,529 @@
-import numpy as np
-import os
-import sys
-import starfish
-from starfish import Experiment
-from starfish.types import Features, Axes
-from starfish import IntensityTable
-from starfish.image import Filter
-from starfish.spots import DetectPixels
-from datetime import datetime
-
-
-def DARTFISH_pipeline(fov, codebook, magnitude_threshold, normalize,
-                      area_threshold=(5, 100), distance_threshold=3):
-    imgs = fov.get_image(starfish.FieldOfView.PRIMARY_IMAGES)
-
-    gauss_filt = Filter.GaussianLowPass(0.7, True)
-    gauss_imgs = gauss_filt.run(imgs)
-
-    sc_filt = Filter.Clip(p_max=100, expand_dynamic_range=True)
-    norm_imgs = sc_filt.run(gauss_imgs)
-
-    z_filt = Filter.ZeroByChannelMagnitude(thresh=.05, normalize=normalize)
-    filtered_imgs = z_filt.run(norm_imgs)
-
-    def compute_magnitudes(stack, norm_order=2):
-        pixel_intensities = IntensityTable.from_image_stack(stack)
-        feature_traces = pixel_intensities.stack(traces=(Axes.CH.value, Axes.ROUND.value))
-        norm = np.linalg.norm(feature_traces.values, ord=norm_order, axis=1)
-        return norm
-
-    mags = compute_magnitudes(filtered_imgs)
-
-    psd = DetectPixels.PixelSpotDecoder(
-        codebook=codebook,
-        metric='euclidean',
-        distance_threshold=distance_threshold,
-        magnitude_threshold=magnitude_threshold,
-        min_area=area_threshold[0],
-        max_area=area_threshold[1]
-    )
-
-    spot_intensities, results = psd.run(filtered_imgs)
-    spot_intensities = IntensityTable(spot_intensities.where(spot_intensities[Features.PASSES_THRESHOLDS], drop=True))
-    # reshape the spot intensity table into a RxC barcode vector
-    pixel_traces = spot_intensities.stack(traces=(Axes.ROUND.value, Axes.CH.value))
-
-    # extract dataframe from spot intensity table for indexing purposes
-    pixel_traces_df = pixel_traces.to_features_dataframe()
-    pixel_traces_df['area'] = np.pi * pixel_traces_df.radius ** 2
-    return pixel_traces_df, mags
-
-
-def process_experiment(experiment: starfish.Experiment, output_dir, magnitude_threshold, normalize,
-                       area_threshold=(5, 100), distance_threshold=3):
-    decoded_intensities = {}
-    regions = {}
-    count = 0
-    for i, (name_, fov) in enumerate(experiment.items()):
-        print(datetime.now().strftime(
-            '%Y-%d-%m_%H:%M:%S: Started Processing FOV {:03d} with Barcode Magnitude threshold {}'.format(count,
-                                                                                                          magnitude_threshold)))
-        pixel_traces_df, mags = DARTFISH_pipeline(fov, experiment.codebook, magnitude_threshold, normalize,
-                                                  area_threshold, distance_threshold)
-        pixel_traces_df.to_csv(
-            os.path.join(output_dir, 'starfish_table_bcmag_{}_FOV{:03d}'.format(magnitude_threshold, count) + '.csv'))
-        print(datetime.now().strftime(
-            '%Y-%d-%m_%H:%M:%S: Finished Processing FOV {:03d} with Barcode Magnitude threshold {}'.format(count,
-                                                                                                           magnitude_threshold)))
-        count += 1
-
-
-def starfish_decode(output_dir, decode_dir, magnitude_thresholds=[2.0, 0.9],
-                    area_threshold=(5, 100), distance_threshold=3, normalize=True):
-    currentTime = datetime.now()
-    reportFile = os.path.join(output_dir, currentTime.strftime("%Y-%d-%m_%H:%M_starfish.log"))
-    sys.stdout = open(reportFile, 'x')  # redirecting the stdout to the log file
-    exp = Experiment.from_json(os.path.join(decode_dir, "experiment.json"))
-
-    for magnitude_threshold in magnitude_thresholds:
-        output_path = os.path.join(output_dir, "bcmag{}".format(magnitude_threshold))
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-        print(datetime.now().strftime(
-            '%Y-%d-%m_%H:%M:%S: Started Processing Experiment with Barcode Magnitude threshold ' + str(
-                magnitude_threshold)))
-        sys.stdout.flush()
-        process_experiment(exp, output_path, magnitude_threshold, normalize=normalize,
-                           area_threshold=area_threshold, distance_threshold=distance_threshold)
-        print(datetime.now().strftime(
-            '%Y-%d-%m_%H:%M:%S: Finished Processing Experiment with Barcode Magnitude threshold ' + str(
-                magnitude_threshold)))
-        sys.stdout.flush()
-    # restoring the stdout pipe to normal
-    sys.stdout = sys.__stdout__
+import numpy as np
+import pandas as pd
+import os
+import logging
+import starfish
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from starfish import Experiment
+from starfish.types import Features, Axes, Coordinates
+from starfish import IntensityTable
+from starfish.image import Filter
+from starfish.spots import DetectPixels
+from starfish.core.spots.DetectPixels.combine_adjacent_features import CombineAdjacentFeatures
+from starfish.core.intensity_table.intensity_table_coordinates import transfer_physical_coords_to_intensity_table
+from spPipeline.metrics import measure
+from spPipeline.pixelDecoder import decode_pixels, call_spots, tile_grid, compare_spots
+from spPipeline.stageLogging import stage_log
+
+logger = logging.getLogger(__name__)
+
+# pixels loaded around a tile so that the Gaussian low-pass (sigma 0.7, truncated at 4 sigma) of its
+# pixels is the same as on the whole FOV
+filter_halo = 4
+
+
+# column types of the Parquet spot tables (the CSV tables keep what pandas infers when reading them)
+spot_table_dtypes = {'z': 'int32', 'y': 'int32', 'x': 'int32', 'target': 'category', 'radius': 'float32',
+                     'spot_id': 'int32', 'distance': 'float32', 'passes_thresholds': 'bool', 'features': 'int32',
+                     'area': 'float32'}
+
+
+def decoded_table_path(output_path, magnitude_threshold, fov_index, table_format='csv'):
+    """ decoded spot table of one FOV in output_path (the bcmag<threshold> directory) """
+    return os.path.join(output_path, 'starfish_table_bcmag_{}_FOV{:03d}'.format(magnitude_threshold, fov_index) +
+                        '.' + table_format)
+
+
+def write_spot_table(pixel_traces_df, table_path):
+    """ Writes a decoded spot table as CSV or, for a .parquet path, as compressed Parquet with the
+        types of `spot_table_dtypes` (physical coordinates stay float64)
+    """
+    if table_path.endswith('.parquet'):
+        pixel_traces_df.astype({column: dtype for column, dtype in spot_table_dtypes.items()
+                                if column in pixel_traces_df}).to_parquet(table_path, compression='zstd',
+                                                                          index=False)
+    else:
+        pixel_traces_df.to_csv(table_path)
+
+
+def filter_primary_images(fov, normalize, expand_dynamic_range=True, x=None, y=None, image_maxima=None):
+    """ Gaussian low-pass, optional dynamic range expansion and channel-magnitude normalization of
+        the primary images of `fov`, i.e. the stack the pixels are decoded from
+        x, y: slices of the images to load and filter instead of the whole FOV
+        image_maxima: (round, ch, z) maxima of the low-passed images of the whole FOV
+        (`filtered_image_maxima`), to scale a crop as the whole images
+        Without expand_dynamic_range, the whole FOV is divided by one scale, the median of its image
+        maxima: the relative intensities of rounds and channels are kept, while the channel magnitude
+        threshold below and the magnitude thresholds, tuned on expanded images, keep their meaning.
+    """
+    imgs = fov.get_image(starfish.FieldOfView.PRIMARY_IMAGES, x=x, y=y)
+
+    gauss_filt = Filter.GaussianLowPass(0.7, True)
+    gauss_imgs = gauss_filt.run(imgs)
+
+    if expand_dynamic_range and image_maxima is None:
+        sc_filt = Filter.Clip(p_max=100, expand_dynamic_range=True)
+        norm_imgs = sc_filt.run(gauss_imgs)
+    else:
+        data = gauss_imgs.xarray.values
+        if image_maxima is None:
+            image_maxima = data.max(axis=(3, 4))
+        if expand_dynamic_range:
+            # what Clip(p_max=100) does to every (round, ch, z) image: scaled by its maximum
+            data /= np.where(image_maxima > 0, image_maxima, 1)[:, :, :, np.newaxis, np.newaxis]
+        elif np.median(image_maxima) > 0:
+            data /= np.median(image_maxima)
+        norm_imgs = gauss_imgs
+
+    z_filt = Filter.ZeroByChannelMagnitude(thresh=.05, normalize=normalize)
+    return z_filt.run(norm_imgs)
+
+
+def magnitude_histogram_path(histogram_dir, normalize, fov_index):
+    return os.path.join(histogram_dir, 'magnitude_histogram_norm{}_FOV{:03d}.csv'.format(normalize, fov_index))
+
+
+def compute_magnitudes(stack):
+    """ L2 magnitude of the (round, channel) trace of every pixel of an ImageStack, in the
+        (z, y, x) order of IntensityTable.from_image_stack, computed on the stack's array
+    """
+    data = stack.xarray.values  # (round, ch, z, y, x)
+    return np.sqrt(np.einsum('rczyx,rczyx->zyx', data, data)).ravel()
+
+
+def write_magnitude_histogram(magnitudes, histogram_path, bins=100):
+    """ diagnostic histogram of the pixel magnitudes, to pick magnitude thresholds """
+    counts, edges = np.histogram(magnitudes, bins=bins)
+    pd.DataFrame({'bin_start': edges[:-1], 'bin_end': edges[1:], 'count': counts}).to_csv(histogram_path,
+                                                                                          index=False)
+
+
+def spots_to_dataframe(spot_intensities):
+    spot_intensities = IntensityTable(spot_intensities.where(spot_intensities[Features.PASSES_THRESHOLDS], drop=True))
+    # reshape the spot intensity table into a RxC barcode vector
+    pixel_traces = spot_intensities.stack(traces=(Axes.ROUND.value, Axes.CH.value))
+
+    # extract dataframe from spot intensity table for indexing purposes
+    pixel_traces_df = pixel_traces.to_features_dataframe()
+    pixel_traces_df['area'] = np.pi * pixel_traces_df.radius ** 2
+    return pixel_traces_df
+
+
+def numpy_decode(filtered_imgs, codebook, magnitude_thresholds, area_threshold=(5, 100), distance_threshold=3,
+                 histogram_path=None, precision='float32'):
+    """ {threshold: spot dataframe} of a filtered ImageStack from the in-project NumPy decoder
+        (`pixelDecoder`) instead of PixelSpotDecoder: one float32 matrix product against the normalized
+        codebook per batch of pixels, no IntensityTable. Pixels are decoded once; every threshold only
+        redoes the connected-component spot calling. Tables have the columns of the starfish ones.
+        precision: 'float32' or 'float64', dtype of the decoding
+    """
+    data = filtered_imgs.xarray.values  # (round, ch, z, y, x)
+    codes = codebook.transpose(Features.TARGET, Axes.ROUND.value, Axes.CH.value).values
+    target_index, distances, magnitudes = decode_pixels(data, codes, dtype=np.dtype(precision))
+    if histogram_path is not None:
+        write_magnitude_histogram(magnitudes.ravel(), histogram_path)
+
+    physical_coords = {'z': filtered_imgs.xarray[Coordinates.Z.value].values,
+                       'y': filtered_imgs.xarray[Coordinates.Y.value].values,
+                       'x': filtered_imgs.xarray[Coordinates.X.value].values}
+    targets = codebook[Features.TARGET].values
+    return {magnitude_threshold: call_spots(target_index, distances, magnitudes, targets, magnitude_threshold,
+                                            distance_threshold, area_threshold, physical_coords)
+            for magnitude_threshold in magnitude_thresholds}
+
+
+def fov_image_shape(fov):
+    """ (height, width) of the primary images of `fov`, loading a single column and row of them """
+    height = fov.get_image(starfish.FieldOfView.PRIMARY_IMAGES, x=slice(0, 1)).tile_shape[0]
+    width = fov.get_image(starfish.FieldOfView.PRIMARY_IMAGES, y=slice(0, 1)).tile_shape[1]
+    return height, width
+
+
+def halo_slices(window, image_shape):
+    """ y, x slices of a (y_start, y_stop, x_start, x_stop) window grown by `filter_halo` within the
+        image, and the window's position in the grown one as ImageStack.isel indexers
+    """
+    y_start, x_start = max(window[0] - filter_halo, 0), max(window[2] - filter_halo, 0)
+    y = slice(y_start, min(window[1] + filter_halo, image_shape[0]))
+    x = slice(x_start, min(window[3] + filter_halo, image_shape[1]))
+    inner = {Axes.Y: (window[0] - y_start, window[1] - y_start), Axes.X: (window[2] - x_start, window[3] - x_start)}
+    return y, x, inner
+
+
+def filtered_image_maxima(fov, tiles, image_shape):
+    """ (round, ch, z) maxima of the low-passed primary images of `fov`, computed tile by tile """
+    maxima = None
+    for core, _ in tiles:
+        y, x, inner = halo_slices(core, image_shape)
+        gauss_imgs = Filter.GaussianLowPass(0.7, True).run(
+            fov.get_image(starfish.FieldOfView.PRIMARY_IMAGES, x=x, y=y))
+        (y_start, y_stop), (x_start, x_stop) = inner[Axes.Y], inner[Axes.X]
+        tile_maxima = gauss_imgs.xarray.values[:, :, :, y_start:y_stop, x_start:x_stop].max(axis=(3, 4))
+        maxima = tile_maxima if maxima is None else np.maximum(maxima, tile_maxima)
+    return maxima
+
+
+def decode_stack_pixels(filtered_imgs, codebook, distance_threshold, decoder='starfish', precision='float32'):
+    """ target index (in the codebook), distance and magnitude of every pixel of a filtered ImageStack,
+        each (z, y, x), from Codebook.decode_metric or from `pixelDecoder.decode_pixels` in `precision`
+    """
+    if decoder == 'numpy':
+        codes = codebook.transpose(Features.TARGET, Axes.ROUND.value, Axes.CH.value).values
+        return decode_pixels(filtered_imgs.xarray.values, codes, dtype=np.dtype(precision))
+
+    shape = filtered_imgs.xarray.shape[2:]
+    pixel_intensities = IntensityTable.from_image_stack(filtered_imgs)
+    decoded_intensities = codebook.decode_metric(pixel_intensities, max_distance=distance_threshold,
+                                                 min_intensity=0, norm_order=2, metric='euclidean')
+    target_index = pd.Index(codebook[Features.TARGET].values).get_indexer(
+        decoded_intensities[Features.TARGET].values)
+    return (target_index.reshape(shape), decoded_intensities[Features.DISTANCE].values.reshape(shape),
+            compute_magnitudes(filtered_imgs).reshape(shape))
+
+
+def DARTFISH_pipeline_tiled(fov, codebook, magnitude_thresholds, normalize, tile_size,
+                            area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True,
+                            histogram_path=None, decoder='starfish', precision='float32'):
+    """ `DARTFISH_pipeline_thresholds` on overlapping tile_size x tile_size tiles of the FOV, one at a time,
+        so that the memory taken by the filtered stack and the pixel decoding is set by the tile size
+        rather than the FOV size. Tiles overlap by max_area pixels and every spot is called whole in the
+        one tile its centroid falls in (`pixelDecoder.call_spots`), so spots across seams are neither
+        split nor duplicated. Scaling the images needs the maxima of the whole images: the images are
+        low-passed twice, once to get them.
+    """
+    image_shape = fov_image_shape(fov)
+    tiles = tile_grid(image_shape, tile_size, overlap=area_threshold[1])
+    image_maxima = filtered_image_maxima(fov, tiles, image_shape)
+    targets = codebook[Features.TARGET].values
+
+    spots = {magnitude_threshold: [] for magnitude_threshold in magnitude_thresholds}
+    core_magnitudes = []
+    for core, extended in tiles:
+        y, x, inner = halo_slices(extended, image_shape)
+        filtered_imgs = filter_primary_images(fov, normalize, expand_dynamic_range, x=x, y=y,
+                                              image_maxima=image_maxima).isel(inner)
+        target_index, distances, magnitudes = decode_stack_pixels(filtered_imgs, codebook, distance_threshold,
+                                                                  decoder, precision)
+        if histogram_path is not None:
+            core_magnitudes.append(magnitudes[:, core[0] - extended[0]:core[1] - extended[0],
+                                              core[2] - extended[2]:core[3] - extended[2]].ravel())
+
+        physical_coords = {'z': filtered_imgs.xarray[Coordinates.Z.value].values,
+                           'y': filtered_imgs.xarray[Coordinates.Y.value].values,
+                           'x': filtered_imgs.xarray[Coordinates.X.value].values}
+        for magnitude_threshold in magnitude_thresholds:
+            spots[magnitude_threshold].append(call_spots(target_index, distances, magnitudes, targets,
+                                                         magnitude_threshold, distance_threshold, area_threshold,
+                                                         physical_coords, tile=(core, extended),
+                                                         image_shape=image_shape))
+    if histogram_path is not None:
+        write_magnitude_histogram(np.concatenate(core_magnitudes), histogram_path)
+
+    for magnitude_threshold, tile_spots in spots.items():
+        spots[magnitude_threshold] = pd.concat(tile_spots, ignore_index=True)
+        spots[magnitude_threshold]['spot_id'] = spots[magnitude_threshold]['features'] = \
+            np.arange(len(spots[magnitude_threshold]))
+    return spots
+
+
+def DARTFISH_pipeline(fov, codebook, magnitude_threshold, normalize,
+                      area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True,
+                      histogram_path=None, decoder='starfish', tile_size=None, precision='float32'):
+    """ expand_dynamic_range: rescale each image to its full range (needed for the 8-bit registered images);
+        False decodes the native-range (uint16/float32) registered images with one scale for the whole
+        FOV (see `filter_primary_images`), so that the thresholds mean the same in both modes
+        histogram_path: if given, a histogram of the pixel magnitudes is written there
+        decoder: 'starfish' (PixelSpotDecoder) or 'numpy' (`numpy_decode`)
+        tile_size: if given, the FOV is decoded in tiles of that size (`DARTFISH_pipeline_tiled`)
+        precision: 'float32' or 'float64' pixel decoding with the 'numpy' decoder (PixelSpotDecoder
+        computes distances in float64 whatever this is)
+    """
+    if tile_size:
+        return DARTFISH_pipeline_tiled(fov, codebook, [magnitude_threshold], normalize, tile_size, area_threshold,
+                                       distance_threshold, expand_dynamic_range, histogram_path,
+                                       decoder, precision)[magnitude_threshold]
+    filtered_imgs = filter_primary_images(fov, normalize, expand_dynamic_range)
+    if decoder == 'numpy':
+        return numpy_decode(filtered_imgs, codebook, [magnitude_threshold], area_threshold, distance_threshold,
+                            histogram_path=histogram_path, precision=precision)[magnitude_threshold]
+    if histogram_path is not None:
+        write_magnitude_histogram(compute_magnitudes(filtered_imgs), histogram_path)
+
+    psd = DetectPixels.PixelSpotDecoder(
+        codebook=codebook,
+        metric='euclidean',
+        distance_threshold=distance_threshold,
+        magnitude_threshold=magnitude_threshold,
+        min_area=area_threshold[0],
+        max_area=area_threshold[1]
+    )
+
+    spot_intensities, results = psd.run(filtered_imgs)
+    return spots_to_dataframe(spot_intensities)
+
+
+def DARTFISH_pipeline_thresholds(fov, codebook, magnitude_thresholds, normalize,
+                                 area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True,
+                                 histogram_path=None, decoder='starfish', tile_size=None, precision='float32'):
+    """ `DARTFISH_pipeline` for several magnitude thresholds at once: {threshold: spot dataframe}.
+        The images are filtered and every pixel is matched to its nearest codeword once, with the lowest
+        threshold; each threshold then only re-marks the pixels passing it (magnitude >= threshold and
+        distance <= distance_threshold, as PixelSpotDecoder does) and combines them into spots.
+    """
+    if tile_size:
+        return DARTFISH_pipeline_tiled(fov, codebook, magnitude_thresholds, normalize, tile_size, area_threshold,
+                                       distance_threshold, expand_dynamic_range, histogram_path, decoder, precision)
+    filtered_imgs = filter_primary_images(fov, normalize, expand_dynamic_range)
+    if decoder == 'numpy':
+        return numpy_decode(filtered_imgs, codebook, magnitude_thresholds, area_threshold, distance_threshold,
+                            histogram_path=histogram_path, precision=precision)
+    mags = compute_magnitudes(filtered_imgs)
+    if histogram_path is not None:
+        write_magnitude_histogram(mags, histogram_path)
+    pixel_intensities = IntensityTable.from_image_stack(filtered_imgs)
+    decoded_intensities = codebook.decode_metric(pixel_intensities, max_distance=distance_threshold,
+                                                 min_intensity=min(magnitude_thresholds), norm_order=2,
+                                                 metric='euclidean')
+    within_distance = decoded_intensities[Features.DISTANCE].values <= distance_threshold
+
+    caf = CombineAdjacentFeatures(min_area=area_threshold[0], max_area=area_threshold[1],
+                                  mask_filtered_features=True)
+    spots = {}
+    for magnitude_threshold in magnitude_thresholds:
+        thresholded = decoded_intensities.copy()
+        thresholded[Features.PASSES_THRESHOLDS] = (Features.AXIS,
+                                                   np.logical_and(mags >= magnitude_threshold, within_distance))
+        spot_intensities, results = caf.run(intensities=thresholded)
+        # xc, yc, zc, as PixelSpotDecoder adds them
+        transfer_physical_coords_to_intensity_table(image_stack=filtered_imgs, intensity_table=spot_intensities)
+        spots[magnitude_threshold] = spots_to_dataframe(spot_intensities)
+    return spots
+
+
+def precision_report(fov, codebook, magnitude_thresholds, normalize, area_threshold=(5, 100), distance_threshold=3,
+                     expand_dynamic_range=True):
+    """ Validation of float32 pixel decoding against float64 on one FOV, one row per threshold: agreement
+        of the nearest codeword of the pixels passing the thresholds in float64, largest differences of
+        the pixel distances and magnitudes, and the spot calls of both (`pixelDecoder.compare_spots`).
+        Both decode the same filtered stack (starfish stores it in float32).
+    """
+    filtered_imgs = filter_primary_images(fov, normalize, expand_dynamic_range)
+    data = filtered_imgs.xarray.values
+    codes = codebook.transpose(Features.TARGET, Axes.ROUND.value, Axes.CH.value).values
+    reference = decode_pixels(data, codes, dtype=np.float64)
+    decoded = decode_pixels(data, codes, dtype=np.float32)
+    physical_coords = {'z': filtered_imgs.xarray[Coordinates.Z.value].values,
+                       'y': filtered_imgs.xarray[Coordinates.Y.value].values,
+                       'x': filtered_imgs.xarray[Coordinates.X.value].values}
+    targets = codebook[Features.TARGET].values
+
+    rows = []
+    for magnitude_threshold in magnitude_thresholds:
+        passes = np.logical_and(reference[2] >= magnitude_threshold, reference[1] <= distance_threshold)
+        row = {'magnitude_threshold': magnitude_threshold, 'n_pixels_passing': int(passes.sum()),
+               'pixel_target_agreement': float(np.mean(reference[0][passes] == decoded[0][passes]))
+               if passes.any() else 1.0,
+               'max_pixel_distance_difference': float(np.abs(reference[1] - decoded[1]).max()),
+               'max_pixel_magnitude_difference': float(np.abs(reference[2] - decoded[2]).max())}
+        row.update(compare_spots(*(call_spots(*pixels, targets, magnitude_threshold, distance_threshold,
+                                              area_threshold, physical_coords)
+                                   for pixels in (reference, decoded))))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def write_precision_report(decode_dir, output_dir, fov_index, magnitude_thresholds, normalize,
+                           area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True, fov_name=None):
+    """ `precision_report` of the `fov_index`-th FOV of the experiment in `decode_dir`, written to
+        output_dir/precision_report_norm<normalize>_FOV<index>.csv; returns the report
+    """
+    exp = Experiment.from_json(os.path.join(decode_dir, "experiment.json"))
+    if fov_name is None:
+        fov_name = list(exp.keys())[fov_index]
+    with measure('precision report', fov=fov_index):
+        report = precision_report(exp[fov_name], exp.codebook, magnitude_thresholds, normalize, area_threshold,
+                                  distance_threshold, expand_dynamic_range)
+    report.to_csv(os.path.join(output_dir, 'precision_report_norm{}_FOV{:03d}.csv'.format(normalize, fov_index)),
+                  index=False)
+    logger.info('float32 vs float64 decoding of FOV {:03d}:\n{}'.format(fov_index, report.to_string(index=False)))
+    return report
+
+
+def process_experiment(experiment: starfish.Experiment, output_dir, magnitude_threshold, normalize,
+                       area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True, histogram_dir=None,
+                       decoder='starfish', tile_size=None, precision='float32', table_format='csv'):
+    decoded_intensities = {}
+    regions = {}
+    count = 0
+    for i, (name_, fov) in enumerate(experiment.items()):
+        logger.info('Started Processing FOV {:03d} with Barcode Magnitude threshold {}'.format(count, magnitude_threshold))
+        with measure('decode', fov=count, bcmag=magnitude_threshold):
+            pixel_traces_df = DARTFISH_pipeline(fov, experiment.codebook, magnitude_threshold, normalize,
+                                                area_threshold, distance_threshold,
+                                                expand_dynamic_range=expand_dynamic_range,
+                                                histogram_path=None if histogram_dir is None else
+                                                magnitude_histogram_path(histogram_dir, normalize, count),
+                                                decoder=decoder, tile_size=tile_size, precision=precision)
+            write_spot_table(pixel_traces_df, decoded_table_path(output_dir, magnitude_threshold, count, table_format))
+        logger.info('Finished Processing FOV {:03d} with Barcode Magnitude threshold {}'.format(count, magnitude_threshold))
+        count += 1
+
+
+def process_experiment_thresholds(experiment: starfish.Experiment, output_dir, magnitude_thresholds, normalize,
+                                  area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True,
+                                  histogram_dir=None, decoder='starfish', tile_size=None, precision='float32',
+                                  table_format='csv'):
+    """ `process_experiment` for several thresholds, filtering and decoding each FOV once
+        (`DARTFISH_pipeline_thresholds`); tables go to output_dir/bcmag<threshold>
+    """
+    for count, (name_, fov) in enumerate(experiment.items()):
+        logger.info('Started Processing FOV {:03d} with Barcode Magnitude thresholds {}'.format(count,
+                                                                                                magnitude_thresholds))
+        with measure('decode', fov=count, bcmag=magnitude_thresholds):
+            spots = DARTFISH_pipeline_thresholds(fov, experiment.codebook, magnitude_thresholds, normalize,
+                                                 area_threshold, distance_threshold,
+                                                 expand_dynamic_range=expand_dynamic_range,
+                                                 histogram_path=None if histogram_dir is None else
+                                                 magnitude_histogram_path(histogram_dir, normalize, count),
+                                                 decoder=decoder, tile_size=tile_size, precision=precision)
+            for magnitude_threshold, pixel_traces_df in spots.items():
+                write_spot_table(pixel_traces_df,
+                                 decoded_table_path(os.path.join(output_dir, "bcmag{}".format(magnitude_threshold)),
+                                                    magnitude_threshold, count, table_format))
+        logger.info('Finished Processing FOV {:03d} with Barcode Magnitude thresholds {}'.format(count,
+                                                                                                 magnitude_thresholds))
+
+
+def decode_fov(decode_dir, output_dir, fov_index, magnitude_thresholds, normalize,
+               area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True, fov_name=None,
+               multi_threshold=False, histogram_dir=None, decoder='starfish', tile_size=None,
+               precision='float32', table_format='csv'):
+    """ Decodes only the `fov_index`-th FOV of the experiment in `decode_dir` (one scheduler or pool task),
+        writing the same tables as `process_experiment` to output_dir/bcmag<threshold> for every threshold.
+        fov_name: name of that FOV in the experiment (e.g. 'fov_003'), if known
+        multi_threshold: filter and decode the FOV once for all thresholds (`DARTFISH_pipeline_thresholds`)
+        histogram_dir: if given, the FOV's magnitude histogram is written there
+        decoder, tile_size, precision: see `DARTFISH_pipeline`
+        table_format: 'csv' or 'parquet' spot tables (`write_spot_table`)
+    """
+    exp = Experiment.from_json(os.path.join(decode_dir, "experiment.json"))
+    if fov_name is None:
+        fov_name = list(exp.keys())[fov_index]
+    fov = exp[fov_name]
+    for magnitude_threshold in magnitude_thresholds:
+        os.makedirs(os.path.join(output_dir, "bcmag{}".format(magnitude_threshold)), exist_ok=True)
+
+    # one log per worker process, appended to by every FOV it decodes
+    with stage_log('starfish', output_dir, worker='pid{}'.format(os.getpid())), \
+            measure('decode', fov=fov_index, bcmag=magnitude_thresholds):
+        logger.info('Started Processing FOV {:03d} with Barcode Magnitude thresholds {}'.format(fov_index,
+                                                                                                magnitude_thresholds))
+        histogram_path = None if histogram_dir is None else magnitude_histogram_path(histogram_dir, normalize,
+                                                                                       fov_index)
+        if multi_threshold:
+            spots = DARTFISH_pipeline_thresholds(fov, exp.codebook, magnitude_thresholds, normalize,
+                                                 area_threshold, distance_threshold,
+                                                 expand_dynamic_range=expand_dynamic_range,
+                                                 histogram_path=histogram_path, decoder=decoder,
+                                                 tile_size=tile_size, precision=precision)
+        else:
+            # the histogram does not depend on the threshold: written with the first one only
+            spots = {magnitude_threshold: DARTFISH_pipeline(fov, exp.codebook, magnitude_threshold, normalize,
+                                                            area_threshold, distance_threshold,
+                                                            expand_dynamic_range=expand_dynamic_range,
+                                                            histogram_path=histogram_path if i == 0 else None,
+                                                            decoder=decoder, tile_size=tile_size,
+                                                            precision=precision)
+                     for i, magnitude_threshold in enumerate(magnitude_thresholds)}
+        for magnitude_threshold, pixel_traces_df in spots.items():
+            write_spot_table(pixel_traces_df,
+                             decoded_table_path(os.path.join(output_dir, "bcmag{}".format(magnitude_threshold)),
+                                                magnitude_threshold, fov_index, table_format))
+        logger.info('Finished Processing FOV {:03d} with Barcode Magnitude thresholds {}'.format(fov_index,
+                                                                                                 magnitude_thresholds))
+    return fov_index
+
+
+def process_experiment_parallel(decode_dir, fov_names, output_dir, magnitude_thresholds, normalize,
+                                area_threshold=(5, 100), distance_threshold=3, expand_dynamic_range=True,
+                                workers=2, multi_threshold=False, histogram_dir=None, decoder='starfish',
+                                tile_size=None, precision='float32', table_format='csv'):
+    """ Same as `process_experiment` for every threshold, but every (threshold, FOV) is a job on a pool of
+        `workers` processes (every FOV with `multi_threshold`). Each job loads its own FOV from
+        decode_dir/experiment.json; tables keep the FOV's index in `fov_names` (the experiment order),
+        so they are named as in the serial loop.
+    """
+    threshold_groups = [magnitude_thresholds] if multi_threshold else [[t] for t in magnitude_thresholds]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(decode_fov, decode_dir, output_dir, fov_index, thresholds, normalize,
+                                   area_threshold, distance_threshold, expand_dynamic_range, fov_name,
+                                   multi_threshold, histogram_dir if thresholds is threshold_groups[0] else None,
+                                   decoder, tile_size, precision, table_format):
+                   thresholds
+                   for thresholds in threshold_groups
+                   for fov_index, fov_name in enumerate(fov_names)}
+        for future in as_completed(futures):
+            logger.info('Decoded FOV {:03d} with Barcode Magnitude thresholds {}'.format(future.result(),
+                                                                                         futures[future]))
+
+
+def starfish_decode(output_dir, decode_dir, magnitude_thresholds=[2.0, 0.9],
+                    area_threshold=(5, 100), distance_threshold=3, normalize=True, expand_dynamic_range=True,
+                    workers=1, multi_threshold=False, magnitude_histograms=False, decoder='starfish',
+                    tile_size=None, precision='float32', table_format='csv'):
+    """ workers: number of processes decoding FOVs in parallel; 1 decodes them one by one in this process
+        multi_threshold: filter and decode each FOV once for all `magnitude_thresholds`, each threshold only
+        redoing the spot calling, instead of running the whole pipeline once per threshold
+        magnitude_histograms: also write a histogram of the pixel magnitudes of every FOV to
+        output_dir/magnitude_histograms (diagnostic, off by default)
+        decoder: 'starfish' decodes with PixelSpotDecoder, 'numpy' with the in-project `pixelDecoder`
+        tile_size: decode every FOV in overlapping tiles of tile_size x tile_size pixels, one at a time,
+        to bound the memory taken by large FOVs; None decodes whole FOVs
+        precision: 'float32' or 'float64' decoding with the 'numpy' decoder
+        table_format: 'csv' or 'parquet' (typed, compressed; read with column projection by `combineFOVs`)
+    """
+    histogram_dir = None
+    if magnitude_histograms:
+        histogram_dir = os.path.join(output_dir, 'magnitude_histograms')
+        os.makedirs(histogram_dir, exist_ok=True)
+
+    # logged to output_dir/starfish.log (appended to by every pass, rotated when large)
+    with stage_log('starfish', output_dir):
+        exp = Experiment.from_json(os.path.join(decode_dir, "experiment.json"))
+
+        if workers > 1:
+            logger.info('Processing Experiment with Barcode Magnitude thresholds {} on {} workers'.format(
+                magnitude_thresholds, workers))
+            process_experiment_parallel(decode_dir, list(exp.keys()), output_dir,
+                                        magnitude_thresholds, normalize, area_threshold=area_threshold,
+                                        distance_threshold=distance_threshold,
+                                        expand_dynamic_range=expand_dynamic_range, workers=workers,
+                                        multi_threshold=multi_threshold, histogram_dir=histogram_dir,
+                                        decoder=decoder, tile_size=tile_size, precision=precision,
+                                        table_format=table_format)
+            return
+
+        for magnitude_threshold in magnitude_thresholds:
+            output_path = os.path.join(output_dir, "bcmag{}".format(magnitude_threshold))
+            if not os.path.exists(output_path):
+                os.makedirs(output_path)
+
+        if multi_threshold:
+            logger.info('Started Processing Experiment with Barcode Magnitude thresholds {}'.format(magnitude_thresholds))
+            process_experiment_thresholds(exp, output_dir, magnitude_thresholds, normalize=normalize,
+                                          area_threshold=area_threshold, distance_threshold=distance_threshold,
+                                          expand_dynamic_range=expand_dynamic_range, histogram_dir=histogram_dir,
+                                          decoder=decoder, tile_size=tile_size, precision=precision,
+                                          table_format=table_format)
+            logger.info('Finished Processing Experiment with Barcode Magnitude thresholds {}'.format(magnitude_thresholds))
+            return
+
+        for i, magnitude_threshold in enumerate(magnitude_thresholds):
+            output_path = os.path.join(output_dir, "bcmag{}".format(magnitude_threshold))
+            logger.info('Started Processing Experiment with Barcode Magnitude threshold ' + str(magnitude_threshold))
+            process_experiment(exp, output_path, magnitude_threshold, normalize=normalize,
+                               area_threshold=area_threshold, distance_threshold=distance_threshold,
+                               expand_dynamic_range=expand_dynamic_range,
+                               histogram_dir=histogram_dir if i == 0 else None, decoder=decoder,
+                               tile_size=tile_size, precision=precision, table_format=table_format)
+            logger.info('Finished Processing Experiment with Barcode Magnitude threshold ' + str(magnitude_threshold))